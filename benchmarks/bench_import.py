@@ -0,0 +1,175 @@
+"""
+bench_import.py
+
+Import time of the FTP modules, measured with python -X importtime.
+
+The panel imports every enabled module on each reload, so module/ftp.py
+only imports what its routes need on every request and defers the rest.
+This measures the shared modules from module/ in fresh interpreters and
+fails when one of them imports something that should be deferred:
+
+    python3 benchmarks/bench_import.py
+
+module/ftp.py is imported as modules.ftp from a scratch directory with
+stand-ins for app, flask, flask_babel and mysql.connector, so the check
+runs without OpenPanel. On an OpenPanel server the real panel can be
+measured instead, its app is imported first because it is loaded before
+the modules:
+
+    python3 benchmarks/bench_import.py --panel-dir /usr/local/panel --max-ms 20
+"""
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module')
+
+MODULES = ('ftp_users', 'ftp_cache', 'ftp_control', 'ftp_index', 'ftp_xferlog', 'ftp_events', 'ftp_quota')
+# must not be imported by these modules until they are used
+DEFERRED = {
+    'ftp_users': ('crypt', 'secrets', 'sqlite3'),
+    'ftp_cache': ('sqlite3', 'socket'),
+    'modules.ftp': ('mysql.connector', 'flask_babel', 'crypt', 'secrets', 'sqlite3',
+                    'modules.ftp_control', 'modules.ftp_index', 'modules.ftp_xferlog',
+                    'modules.ftp_events', 'modules.ftp_quota', 'modules.ftp_sessions'),
+}
+
+# stand-ins for what module/ftp.py imports from the panel, they import nothing
+PANEL_STUBS = {
+    'app.py': '''
+class App:
+    def route(self, rule, **options):
+        return lambda func: func
+
+
+app = App()
+
+
+def login_required_route(func):
+    return func
+
+
+def log_user_action(*args, **kwargs):
+    pass
+
+
+def get_server_ip():
+    return '127.0.0.1'
+''',
+    'flask/__init__.py': '''
+session = {}
+request = None
+
+
+def jsonify(*args, **kwargs):
+    return args or kwargs
+
+
+def render_template(template, **context):
+    return template
+
+
+class Response:
+    def __init__(self, *args, **kwargs):
+        pass
+''',
+    'flask_babel/__init__.py': '''
+def gettext(message, **variables):
+    return message % variables if variables else message
+''',
+    'mysql/__init__.py': '',
+    'mysql/connector/__init__.py': '',
+    'mysql/connector/pooling.py': '',
+    'modules/__init__.py': '',
+}
+
+# prints the modules that the import added, one per line after the marker
+SCRIPT = '''
+import sys
+%s
+before = set(sys.modules)
+import %s
+print('--imported--')
+print('\\n'.join(sorted(set(sys.modules) - before)))
+'''
+
+
+def import_time(module, cwd, preload=''):
+    """Returns (microseconds of the import, modules it imported)."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT % (preload, module)],
+                            cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    cumulative = None
+    for line in result.stderr.splitlines():
+        # import time:  self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].rstrip() == ' ' + module:
+            cumulative = int(fields[1])
+    imported = result.stdout.split('--imported--\n', 1)[1].split()
+    return cumulative, imported
+
+
+def measure(module, cwd, runs, preload=''):
+    times = []
+    imported = []
+    for _ in range(runs):
+        elapsed, imported = import_time(module, cwd, preload)
+        times.append(elapsed)
+    return min(times), imported
+
+
+def stub_panel(path):
+    """Write the panel stand-ins to path, with module/ftp*.py as its modules package."""
+    for name, source in PANEL_STUBS.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(source.lstrip('\n'))
+    for source in glob.glob(os.path.join(MODULE_DIR, 'ftp*.py')):
+        shutil.copy(source, os.path.join(path, 'modules'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument('--runs', type=int, default=5, help='interpreters per module, the fastest counts')
+    parser.add_argument('--panel-dir', help='OpenPanel directory with app.py and modules/ftp.py')
+    parser.add_argument('--max-ms', type=float, help='fail when module/ftp.py takes longer')
+    args = parser.parse_args()
+
+    stub_dir = None
+    if args.panel_dir:
+        panel_dir = args.panel_dir
+    else:
+        stub_dir = panel_dir = tempfile.mkdtemp(prefix='bench_import')
+        stub_panel(stub_dir)
+    measurements = [(module, MODULE_DIR, '') for module in MODULES]
+    measurements.append(('modules.ftp', panel_dir, 'import app'))
+    try:
+        return run(measurements, args)
+    finally:
+        if stub_dir:
+            shutil.rmtree(stub_dir)
+
+
+def run(measurements, args):
+    failed = False
+    print('%-14s %10s %9s  %s' % ('module', 'time (ms)', 'imports', 'deferred but imported'))
+    for module, cwd, preload in measurements:
+        elapsed, imported = measure(module, cwd, args.runs, preload)
+        eager = [name for name in DEFERRED.get(module, ()) if name in imported]
+        print('%-14s %10.1f %9d  %s' % (module, elapsed / 1000.0, len(imported), ', '.join(eager) or '-'))
+        if eager:
+            failed = True
+        if module == 'modules.ftp' and args.max_ms and elapsed / 1000.0 > args.max_ms:
+            print('modules.ftp takes more than %.1f ms' % args.max_ms)
+            failed = True
+        sys.stdout.flush()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
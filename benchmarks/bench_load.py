@@ -0,0 +1,308 @@
+"""
+bench_load.py
+
+Load test of the FTP server over loopback, with a JSON report per image.
+
+Measures:
+- login: connect, login and quit from concurrent clients, logins per second
+  and latency (every login goes through PAM and ftp_admit.py)
+- list: LIST and NLST latency in a directory with many files
+- transfer: concurrent uploads and downloads, total MB/s
+- pasv: passive listeners held open at once until the port range runs out
+
+The clients are ftplib connections run in threads from asyncio, so nothing
+has to be installed. By default a container of the image is started on
+loopback with one account and removed afterwards:
+
+    python3 benchmarks/bench_load.py --image openpanel/ftp --output new.json
+
+Reports of two image versions can be compared:
+
+    python3 benchmarks/bench_load.py --image openpanel/ftp:old --output old.json
+    python3 benchmarks/bench_load.py --compare old.json new.json
+
+A running server can be measured with --server HOST:PORT, --user and
+--password, its max_per_ip has to allow --clients sessions.
+"""
+import argparse
+import asyncio
+import ftplib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench_throughput
+from bench_throughput import Source, connect
+
+LIST_DIR = 'bench_load_list'
+FILE_NAME = 'bench_load_%d.bin'
+# the container allows every client to connect from 127.0.0.1
+CONTAINER_ENV = ('MAX_CLIENTS=1000', 'MAX_PER_IP=1000')
+# numbers that are compared, and whether higher is better
+COMPARE = (
+    ('login', 'per_second', True),
+    ('login', 'p50_ms', False),
+    ('login', 'p95_ms', False),
+    ('list', 'list_p50_ms', False),
+    ('list', 'nlst_p50_ms', False),
+    ('transfer', 'upload_mb_s', True),
+    ('transfer', 'download_mb_s', True),
+    ('pasv', 'opened', True),
+)
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+async def in_threads(count, func, *args):
+    """Run func(number, *args) count times at once, returns the results."""
+    return await asyncio.gather(*(asyncio.to_thread(func, number, *args) for number in range(count)))
+
+
+def login_worker(number, server, deadline):
+    latencies = []
+    errors = 0
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            ftp = connect(*server, timeout=10)
+            ftp.quit()
+        except (OSError, EOFError, ftplib.Error):
+            errors += 1
+            continue
+        latencies.append(time.monotonic() - start)
+    return latencies, errors
+
+
+async def bench_login(server, clients, duration):
+    start = time.monotonic()
+    results = await in_threads(clients, login_worker, server, start + duration)
+    elapsed = time.monotonic() - start
+    latencies = [latency for result in results for latency in result[0]]
+    return {
+        'clients': clients,
+        'logins': len(latencies),
+        'errors': sum(result[1] for result in results),
+        'per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'max_ms': ms(max(latencies) if latencies else None),
+    }
+
+
+def fill_list_dir(ftp, files):
+    """Create LIST_DIR with files empty files, kept for the next run."""
+    try:
+        ftp.mkd(LIST_DIR)
+    except ftplib.error_perm:
+        pass
+    ftp.cwd(LIST_DIR)
+    existing = set(os.path.basename(name) for name in ftp.nlst())
+    for i in range(files):
+        name = 'file%06d' % i
+        if name not in existing:
+            ftp.storbinary('STOR ' + name, Source(0))
+
+
+def bench_list(server, files, runs):
+    ftp = connect(*server)
+    try:
+        fill_list_dir(ftp, files)
+        timings = {'LIST': [], 'NLST': []}
+        entries = 0
+        for _ in range(runs):
+            for command in ('LIST', 'NLST'):
+                lines = []
+                start = time.monotonic()
+                ftp.retrlines(command, lines.append)
+                timings[command].append(time.monotonic() - start)
+                entries = len(lines)
+    finally:
+        ftp.close()
+    return {
+        'files': files,
+        'entries': entries,
+        'list_p50_ms': ms(percentile(timings['LIST'], 50)),
+        'list_max_ms': ms(max(timings['LIST'])),
+        'nlst_p50_ms': ms(percentile(timings['NLST'], 50)),
+        'nlst_max_ms': ms(max(timings['NLST'])),
+    }
+
+
+def upload_worker(number, server, size):
+    ftp = connect(*server)
+    try:
+        ftp.storbinary('STOR ' + FILE_NAME % number, Source(size), bench_throughput.BLOCK_SIZE)
+    finally:
+        ftp.close()
+
+
+def download_worker(number, server, size):
+    received = [0]
+
+    def sink(data):
+        received[0] += len(data)
+
+    ftp = connect(*server)
+    try:
+        ftp.retrbinary('RETR ' + FILE_NAME % number, sink, bench_throughput.BLOCK_SIZE)
+        ftp.delete(FILE_NAME % number)
+    finally:
+        ftp.close()
+    if received[0] != size:
+        raise RuntimeError('downloaded %d of %d bytes' % (received[0], size))
+
+
+async def bench_transfer(server, clients, size):
+    megabytes = clients * size / 1024 / 1024
+    start = time.monotonic()
+    await in_threads(clients, upload_worker, server, size)
+    upload_time = time.monotonic() - start
+    start = time.monotonic()
+    await in_threads(clients, download_worker, server, size)
+    download_time = time.monotonic() - start
+    return {
+        'clients': clients,
+        'file_mb': size // 1024 // 1024,
+        'upload_mb_s': round(megabytes / upload_time, 1),
+        'download_mb_s': round(megabytes / download_time, 1),
+    }
+
+
+def bench_pasv(server, attempts):
+    """
+    Open sessions that each enter passive mode without connecting, until the
+    server refuses or attempts is reached. Every open listener holds a port.
+    """
+    sessions = []
+    latencies = []
+    error = None
+    try:
+        for _ in range(attempts):
+            try:
+                ftp = connect(*server, timeout=10)
+            except (OSError, EOFError, ftplib.Error) as e:
+                error = 'login: %s' % e
+                break
+            sessions.append(ftp)
+            start = time.monotonic()
+            try:
+                ftp.makepasv()
+            except (OSError, EOFError, ftplib.Error) as e:
+                error = 'PASV: %s' % e
+                break
+            latencies.append(time.monotonic() - start)
+    finally:
+        for ftp in sessions:
+            ftp.close()
+    return {
+        'attempts': attempts,
+        'opened': len(latencies),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'max_ms': ms(max(latencies) if latencies else None),
+        'error': error,
+    }
+
+
+async def run(server, args):
+    report = {}
+    print('login...', file=sys.stderr)
+    report['login'] = await bench_login(server, args.clients, args.duration)
+    print('list...', file=sys.stderr)
+    report['list'] = await asyncio.to_thread(bench_list, server, args.files, args.runs)
+    print('transfer...', file=sys.stderr)
+    report['transfer'] = await bench_transfer(server, args.clients, args.size * 1024 * 1024)
+    print('pasv...', file=sys.stderr)
+    report['pasv'] = await asyncio.to_thread(bench_pasv, server, args.pasv)
+    return report
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('%-24s %12s %12s %9s' % ('', old.get('image') or old_path, new.get('image') or new_path, 'change'))
+    for test, key, higher_is_better in COMPARE:
+        before = old['results'].get(test, {}).get(key)
+        after = new['results'].get(test, {}).get(key)
+        change = ''
+        if before and after is not None:
+            percent = (after - before) * 100.0 / before
+            better = percent > 0 if higher_is_better else percent < 0
+            change = '%+.1f%%%s' % (percent, '' if abs(percent) < 5 else ' +' if better else ' -')
+        print('%-24s %12s %12s %9s' % ('%s.%s' % (test, key), before, after, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument('--image', default='openpanel/ftp')
+    parser.add_argument('--profile', default='default', help='FTP_PROFILE of the container')
+    parser.add_argument('--server', help='measure a running server instead, HOST:PORT')
+    parser.add_argument('--user', default=bench_throughput.USER)
+    parser.add_argument('--password', default=bench_throughput.PASSWORD)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of logins')
+    parser.add_argument('--files', type=int, default=5000, help='files in the LIST directory')
+    parser.add_argument('--runs', type=int, default=10, help='LIST and NLST of the directory')
+    parser.add_argument('--size', type=int, default=64, help='MB uploaded and downloaded per client')
+    parser.add_argument('--pasv', type=int, default=bench_throughput.PASV_PORTS * 2,
+                        help='passive listeners to open at most')
+    parser.add_argument('--output', default='-', help='JSON report, - for stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two reports')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = {
+        'image': None if args.server else args.image,
+        'profile': None if args.server else args.profile,
+        'server': args.server,
+        'time': int(time.time()),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'settings': dict((key, getattr(args, key)) for key in ('clients', 'duration', 'files', 'size', 'pasv')),
+    }
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        report['results'] = asyncio.run(run((host, int(port), args.user, args.password), args))
+    else:
+        tmp = tempfile.mkdtemp(prefix='bench_load')
+        try:
+            name, port = bench_throughput.start_container(args.image, args.profile, 0, tmp, CONTAINER_ENV,
+                                                          prefix='bench_load')
+            try:
+                server = ('127.0.0.1', port, args.user, args.password)
+                bench_throughput.wait_for_login(*server)
+                report['results'] = asyncio.run(run(server, args))
+                report['pasv_ports'] = bench_throughput.PASV_PORTS
+            finally:
+                subprocess.run(['docker', 'rm', '-f', name], stdout=subprocess.DEVNULL)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(data)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+
+
+if __name__ == '__main__':
+    main()
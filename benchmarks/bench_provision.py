@@ -0,0 +1,112 @@
+"""
+bench_provision.py
+
+Times container startup account creation for 100, 1k and 10k FTP users,
+with plaintext and with already hashed passwords in users.list.
+
+The python provisioner is always measured against a scratch root, so it can
+run anywhere:
+
+    python3 benchmarks/bench_provision.py
+
+The old per-line adduser loop changes the real /etc/passwd, so --legacy
+must only be used inside a throwaway container:
+
+    docker run --rm -v $PWD:/src --entrypoint python3 openpanel/ftp \\
+        /src/benchmarks/bench_provision.py --legacy
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+import ftp_provision  # noqa: E402
+import ftp_users  # noqa: E402
+
+USERS_PER_OWNER = 100
+
+# create_users() from start_vsftpd.sh before the python provisioner, minus
+# the folder check that skipped every user
+LEGACY_SCRIPT = r'''
+grep '/ftp/' /etc/passwd | cut -d':' -f1 | xargs -r -n1 deluser
+for USER_LIST_FILE in $(find "$1" -name 'users.list'); do
+  while IFS='|' read -r NAME PASS FOLDER; do
+    [ -z "$NAME" ] && continue
+    echo -e "$PASS\n$PASS" | adduser -h $FOLDER -s /sbin/nologin $NAME >/dev/null 2>&1
+    mkdir -p $FOLDER
+    chown $NAME:$NAME $FOLDER
+  done < "$USER_LIST_FILE"
+done
+'''
+
+
+def make_users_dir(path, count, hashed=False):
+    # one hash for all users, only the provisioner should be measured
+    hashed = ftp_users.hash_password('password') if hashed else None
+    for i in range(count):
+        owner = 'owner%d' % (i // USERS_PER_OWNER)
+        owner_dir = os.path.join(path, owner)
+        os.makedirs(owner_dir, exist_ok=True)
+        with open(os.path.join(owner_dir, 'users.list'), 'a') as f:
+            f.write('ftp%d|%s|/home/%s/ftp/ftp%d\n' % (i, hashed or 'password%d' % i, owner, i))
+
+
+def make_root(path):
+    os.makedirs(os.path.join(path, 'etc'))
+    for name in ('passwd', 'shadow', 'group'):
+        src = os.path.join('/etc', name)
+        dst = os.path.join(path, 'etc', name)
+        if os.access(src, os.R_OK):
+            shutil.copy(src, dst)
+        else:
+            open(dst, 'w').close()
+
+
+def bench_python(count, hashed=False):
+    with tempfile.TemporaryDirectory() as tmp:
+        users_dir = os.path.join(tmp, 'users')
+        root = os.path.join(tmp, 'root')
+        make_users_dir(users_dir, count, hashed)
+        make_root(root)
+        start = time.monotonic()
+        ftp_provision.provision(users_dir, root, log=lambda msg: None)
+        return time.monotonic() - start
+
+
+def bench_legacy(count):
+    with tempfile.TemporaryDirectory() as tmp:
+        make_users_dir(tmp, count)
+        start = time.monotonic()
+        subprocess.run(['sh', '-c', LEGACY_SCRIPT, 'sh', tmp], check=True)
+        elapsed = time.monotonic() - start
+        # remove the users again
+        subprocess.run(['sh', '-c', "grep '/ftp/' /etc/passwd | cut -d':' -f1 | xargs -r -n1 deluser"])
+        return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument('--legacy', action='store_true',
+                        help='also time the old adduser loop (modifies /etc/passwd!)')
+    parser.add_argument('--sizes', default='100,1000,10000')
+    args = parser.parse_args()
+
+    if args.legacy and os.geteuid() != 0:
+        parser.error('--legacy needs root inside a throwaway container')
+
+    print('%8s %12s %12s %12s' % ('users', 'python (s)', 'hashed (s)', 'legacy (s)'))
+    for size in (int(s) for s in args.sizes.split(',')):
+        python_time = bench_python(size)
+        hashed_time = bench_python(size, hashed=True)
+        legacy_time = '%12.2f' % bench_legacy(size) if args.legacy else '%12s' % '-'
+        print('%8d %12.2f %12.2f %s' % (size, python_time, hashed_time, legacy_time))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+bench_throughput.py
+
+Upload and download throughput of large files over loopback, per FTP_PROFILE.
+
+By default a container of the image is started for every profile, with a
+scratch users.list holding one account, and removed afterwards:
+
+    python3 benchmarks/bench_throughput.py --profiles compat,default,throughput
+
+compat sends downloads through a read/write loop, default and throughput use
+sendfile, so the difference between them is the zero-copy gain. Running
+servers can be measured instead, they need an account that can upload:
+
+    python3 benchmarks/bench_throughput.py --server local=127.0.0.1:21 \\
+        --user bench --password bench
+"""
+import argparse
+import ftplib
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+USER = 'bench'
+PASSWORD = 'bench'
+FILE_NAME = 'bench_throughput.bin'
+BLOCK_SIZE = 1024 * 1024
+FIRST_PORT = 2121
+# passive ports of the first container, every other one gets the next range
+FIRST_PASV_PORT = 21100
+PASV_PORTS = 10
+START_TIMEOUT = 30
+
+
+class Source:
+    """File-like object that returns size bytes, without touching the disk."""
+
+    def __init__(self, size):
+        self.left = size
+        self.block = os.urandom(BLOCK_SIZE)
+
+    def read(self, size=BLOCK_SIZE):
+        size = min(size, self.left, BLOCK_SIZE)
+        self.left -= size
+        return self.block[:size]
+
+
+def connect(host, port, user, password, timeout=30):
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(host, port)
+    ftp.login(user, password)
+    ftp.voidcmd('TYPE I')
+    return ftp
+
+
+def upload(ftp, size):
+    start = time.monotonic()
+    ftp.storbinary('STOR ' + FILE_NAME, Source(size), BLOCK_SIZE)
+    return time.monotonic() - start
+
+
+def download(ftp, size):
+    received = [0]
+
+    def sink(data):
+        received[0] += len(data)
+
+    start = time.monotonic()
+    ftp.retrbinary('RETR ' + FILE_NAME, sink, BLOCK_SIZE)
+    elapsed = time.monotonic() - start
+    if received[0] != size:
+        raise RuntimeError('downloaded %d of %d bytes' % (received[0], size))
+    return elapsed
+
+
+def bench_server(host, port, user, password, size, runs):
+    """Returns (upload MB/s, [download MB/s of every run])."""
+    ftp = connect(host, port, user, password)
+    try:
+        megabytes = size / 1024 / 1024
+        upload_rate = megabytes / upload(ftp, size)
+        # the first download reads the file into the page cache
+        download(ftp, size)
+        download_rates = [megabytes / download(ftp, size) for _ in range(runs)]
+        ftp.delete(FILE_NAME)
+    finally:
+        ftp.close()
+    return upload_rate, download_rates
+
+
+def wait_for_login(host, port, user, password):
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            connect(host, port, user, password, timeout=5).close()
+            return
+        except (OSError, EOFError, ftplib.Error):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def start_container(image, profile, number, tmp, env=(), prefix='bench_throughput'):
+    """
+    Start a container for profile on loopback, returns (name, port). env is
+    a list of extra VAR=value settings.
+    """
+    users_dir = os.path.join(tmp, profile, 'users')
+    ftp_dir = os.path.join(tmp, profile, 'ftp')
+    os.makedirs(users_dir)
+    os.makedirs(ftp_dir)
+    with open(os.path.join(users_dir, 'users.list'), 'w') as f:
+        f.write('%s|%s|/ftp/%s\n' % (USER, PASSWORD, USER))
+    name = '%s_%s' % (prefix, profile)
+    port = FIRST_PORT + number
+    min_port = FIRST_PASV_PORT + number * PASV_PORTS
+    max_port = min_port + PASV_PORTS - 1
+    env_args = []
+    for setting in env:
+        env_args += ['-e', setting]
+    subprocess.run(['docker', 'rm', '-f', name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    subprocess.run([
+        'docker', 'run', '-d', '--rm', '--name', name,
+        '-p', '127.0.0.1:%d:21' % port,
+        '-p', '127.0.0.1:%d-%d:%d-%d' % (min_port, max_port, min_port, max_port),
+        '-e', 'MIN_PORT=%d' % min_port, '-e', 'MAX_PORT=%d' % max_port,
+        '-e', 'ADDRESS=127.0.0.1', '-e', 'FTP_PROFILE=' + profile, '-e', 'METRICS_PORT=',
+        ] + env_args + [
+        '-v', '%s:/etc/openpanel/ftp/users' % users_dir,
+        '-v', '%s:/ftp' % ftp_dir,
+        image], check=True, stdout=subprocess.DEVNULL)
+    return name, port
+
+
+def parse_server(value):
+    name, _, address = value.rpartition('=')
+    host, _, port = address.rpartition(':')
+    if not name or not host or not port.isdigit():
+        raise argparse.ArgumentTypeError('expected NAME=HOST:PORT, got %s' % value)
+    return name, host, int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument('--profiles', default='compat,default,throughput',
+                        help='FTP_PROFILE values to start containers for')
+    parser.add_argument('--image', default='openpanel/ftp')
+    parser.add_argument('--server', action='append', type=parse_server, default=[],
+                        help='measure a running server instead, NAME=HOST:PORT')
+    parser.add_argument('--user', default=USER)
+    parser.add_argument('--password', default=PASSWORD)
+    parser.add_argument('--size', type=int, default=512, help='file size in MB')
+    parser.add_argument('--runs', type=int, default=3, help='downloads per server')
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+
+    print('%-12s %12s %16s %16s' % ('server', 'up (MB/s)', 'down med (MB/s)', 'down max (MB/s)'))
+
+    def report(name, host, port):
+        upload_rate, download_rates = bench_server(host, port, args.user, args.password, size, args.runs)
+        print('%-12s %12.1f %16.1f %16.1f' % (name, upload_rate, statistics.median(download_rates),
+                                              max(download_rates)))
+        sys.stdout.flush()
+
+    if args.server:
+        for name, host, port in args.server:
+            report(name, host, port)
+        return
+
+    tmp = tempfile.mkdtemp(prefix='bench_throughput')
+    try:
+        for number, profile in enumerate(args.profiles.split(',')):
+            name, port = start_container(args.image, profile, number, tmp)
+            try:
+                wait_for_login('127.0.0.1', port, USER, PASSWORD)
+                report(profile, '127.0.0.1', port)
+            finally:
+                subprocess.run(['docker', 'rm', '-f', name], stdout=subprocess.DEVNULL)
+    finally:
+        # files in the mounted folder belong to the container's users
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
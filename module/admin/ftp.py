@@ -1 +1,243 @@
+"""
+admin/ftp.py
 
+FTP accounts of all OpenPanel users for OpenAdmin.
+"""
+from flask_babel import _
+from flask import request, jsonify, render_template, Response
+import base64
+import json
+import threading
+
+#openadmin
+from app import app, login_required_route
+from modules.ftp_index import AccountIndex, AccountNames, ERRORS as INDEX_ERRORS, SORTS, SEARCH_LIMIT
+from modules.ftp_control import call as ftp_control, import_ops, fill_passwords, ControlError
+
+
+# imports of thousands of accounts hash every plain text password
+FTP_IMPORT_TIMEOUT = 600
+
+
+def ftp_service_error(e):
+    return jsonify({'error': _('FTP service is not available: %(error)s', error=str(e))}), 503
+
+
+# accounts of all users come from the index that the container keeps in
+# /etc/openpanel/ftp/users/index.db, opened once per worker
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = AccountIndex(readonly=True)
+    return _index
+
+
+_names = None
+
+
+def get_names():
+    global _names
+    if _names is None:
+        with _index_lock:
+            if _names is None:
+                _names = AccountNames()
+    return _names
+
+
+@app.route('/ftp', methods=['GET'])
+@login_required_route
+def admin_ftp():
+    try:
+        index = get_index()
+        owners = index.owners()
+    except INDEX_ERRORS as e:
+        return ftp_service_error(e)
+    return render_template('ftp.html', title=_('FTP'), owners=owners, total=sum(owners.values()))
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(value):
+    cursor = json.loads(base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8'))
+    if not isinstance(cursor, list) or len(cursor) != 2:
+        raise ValueError('invalid cursor')
+    return cursor
+
+
+# accounts of all users, a page at a time:
+# /ftp/accounts?username=&owner=&folder=&sort=bytes&order=desc&limit=50&after=
+# username, owner and folder are prefixes, after is the next value of the
+# previous page
+@app.route('/ftp/accounts', methods=['GET'])
+@login_required_route
+def admin_ftp_accounts():
+    sort = request.args.get('sort', 'username')
+    if sort not in SORTS:
+        return jsonify({'error': _('Invalid sort, use one of: %(sorts)s', sorts=', '.join(SORTS))}), 400
+    try:
+        limit = int(request.args.get('limit', SEARCH_LIMIT))
+        after = request.args.get('after')
+        after = decode_cursor(after) if after else None
+    except ValueError:
+        return jsonify({'error': _('Invalid limit or cursor')}), 400
+
+    try:
+        accounts, cursor = get_index().search(
+            username=request.args.get('username', ''),
+            owner=request.args.get('owner', ''),
+            folder=request.args.get('folder', ''),
+            sort=sort, descending=request.args.get('order') == 'desc',
+            after=after, limit=limit)
+    except INDEX_ERRORS as e:
+        return ftp_service_error(e)
+    return jsonify({'accounts': accounts, 'next': encode_cursor(cursor) if cursor else None})
+
+
+@app.route('/ftp/account/<username>', methods=['GET'])
+@login_required_route
+def admin_ftp_account(username):
+    try:
+        account = get_index().get(username)
+    except INDEX_ERRORS as e:
+        return ftp_service_error(e)
+    if account is None:
+        return jsonify({'error': _('FTP account does not exist')}), 404
+    return jsonify(account)
+
+
+# checks a new account before it is added:
+# /ftp/validate?owner=&username=&folder=&uid=
+# the uid must be in the FTP range and not belong to accounts of another owner
+@app.route('/ftp/validate', methods=['GET'])
+@login_required_route
+def admin_ftp_validate():
+    uid = request.args.get('uid') or None
+    if uid is not None:
+        if not uid.isdigit():
+            return jsonify({'error': _('Invalid uid')}), 400
+        uid = int(uid)
+    try:
+        errors = get_names().check(request.args.get('username', ''), request.args.get('owner', ''),
+                                   request.args.get('folder') or None, uid)
+    except INDEX_ERRORS as e:
+        return ftp_service_error(e)
+    return jsonify({'valid': not errors, 'errors': errors})
+
+
+# open sessions of every FTP account
+@app.route('/ftp/sessions', methods=['GET'])
+@login_required_route
+def admin_ftp_sessions():
+    try:
+        result = ftp_control([{'op': 'sessions'}])[0]
+    except (OSError, ControlError) as e:
+        return ftp_service_error(e)
+    return jsonify(result)
+
+
+# live sessions with user, address, command and transfer rate in bytes per
+# second. Pass the version of the previous answer as since to get only the
+# sessions that changed and the pids of the ones that ended, the container
+# reads /proc at most once a second for all requests.
+@app.route('/ftp/sessions/live', methods=['GET'])
+@login_required_route
+def admin_ftp_sessions_live():
+    op = {'op': 'inspect'}
+    since = request.args.get('since')
+    if since:
+        try:
+            op['since'] = int(since)
+        except ValueError:
+            return jsonify({'error': _('Invalid version')}), 400
+    if request.args.get('owner'):
+        op['owner'] = request.args['owner']
+    try:
+        result = ftp_control([op])[0]
+    except (OSError, ControlError) as e:
+        return ftp_service_error(e)
+    if not result.get('ok'):
+        return jsonify({'error': result.get('error')}), 400
+    return jsonify(result)
+
+
+# limits for all accounts of an OpenPanel user, like {"max_rate": 1048576}
+# in bytes per second, 0 or null removes a limit
+@app.route('/ftp/limits/<owner>', methods=['GET', 'POST'])
+@login_required_route
+def admin_ftp_limits(owner):
+    op = {'op': 'limits', 'owner': owner}
+    if request.method == 'POST':
+        op['limits'] = request.get_json(silent=True) or {}
+    try:
+        result = ftp_control([op])[0]
+    except (OSError, ControlError) as e:
+        return ftp_service_error(e)
+    if not result.get('ok'):
+        return jsonify({'error': result.get('error')}), 400
+    return jsonify(result['limits'])
+
+
+# bulk import for one owner, for example when moving customers from another
+# control panel. Nothing is written unless the whole batch is valid, then
+# users.list is written once and the accounts are created in one pass.
+# Accounts without a password get a generated one, returned once.
+@app.route('/ftp/import', methods=['POST'])
+@login_required_route
+def admin_ftp_import():
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and isinstance(data.get('accounts'), list):
+        owner = data.get('owner') or ''
+        ops = [dict(account, op='add', owner=owner)
+               for account in data['accounts'] if isinstance(account, dict)]
+    else:
+        owner = request.args.get('owner', '')
+        ops = import_ops(request.get_data(as_text=True).splitlines(), owner)
+    if not ops:
+        return jsonify({'error': _('No accounts to import')}), 400
+    generated = fill_passwords(ops)
+
+    try:
+        results = ftp_control(ops, timeout=FTP_IMPORT_TIMEOUT, atomic=True)
+    except (OSError, ControlError) as e:
+        return ftp_service_error(e)
+
+    imported = all(result.get('ok') for result in results)
+    errors = [dict(result, username=op.get('username')) for op, result in zip(ops, results)
+              if not result.get('ok') and not result.get('skipped')]
+    return jsonify({'owner': owner, 'imported': len(ops) if imported else 0, 'errors': errors,
+                    'passwords': generated if imported else {}}), 200 if imported else 400
+
+
+# users.list lines with password hashes, of one owner as text that
+# /ftp/import accepts, or of every owner as json
+@app.route('/ftp/export', methods=['GET'])
+@login_required_route
+def admin_ftp_export():
+    owner = request.args.get('owner')
+    if owner is not None:
+        owners = [owner]
+    else:
+        try:
+            owners = list(get_index().owners())
+        except INDEX_ERRORS as e:
+            return ftp_service_error(e)
+
+    try:
+        results = ftp_control([{'op': 'export', 'owner': name} for name in owners])
+    except (OSError, ControlError) as e:
+        return ftp_service_error(e)
+
+    for result in results:
+        if not result.get('ok'):
+            return jsonify({'error': result.get('error')}), 400
+    if owner is not None:
+        return Response(''.join(line + '\n' for line in results[0]['lines']), mimetype='text/plain')
+    return jsonify({name: result['lines'] for name, result in zip(owners, results)})
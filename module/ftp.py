@@ -4,22 +4,400 @@ ftp.py
 https://git.devnet.rs/stefan/2083/-/blob/8bde157a32c9350d58edef652cb8b1265fbd9721/modules/ftp.py
 
 """
-from flask_babel import Babel, _ # https://python-babel.github.io/flask-babel/
-from flask import Flask, g, session, redirect, request
-import re
+from flask import session, request, jsonify, render_template, Response
 import os
-import mysql.connector
-from functools import wraps
-import subprocess
-from subprocess import getoutput, check_output
-import shlex
-import importlib
-import random
-import string
+import threading
 
 #openadmin
 from app import app
-from app import login_required_route, log_user_action, query_username_by_id, get_container_port, get_server_ip
-from modules.core.webserver import get_config_file_path, get_php_version_preference
-from modules.core.config import php_version_for_phpmyadmin_in_containers
+from app import login_required_route, log_user_action, get_server_ip
+from modules.ftp_cache import TTLCache
+from modules import ftp_users
 
+# flask_babel, mysql.connector and the other ftp modules are imported when
+# they are first needed: every panel reload imports all enabled modules,
+# also when nobody opens the FTP page. benchmarks/bench_import.py measures it.
+
+
+def _(message, **variables):
+    from flask_babel import gettext # https://python-babel.github.io/flask-babel/
+    return gettext(message, **variables)
+
+
+# mysql, one pool per panel worker is shared by all requests of this module
+MYSQL_CONFIG_FILE = os.environ.get('FTP_MYSQL_CONFIG', '/usr/local/admin/db.cnf')
+MYSQL_POOL_SIZE = int(os.environ.get('FTP_MYSQL_POOL_SIZE', 5))
+
+QUERY_USERNAME_BY_ID = "SELECT username FROM users WHERE id = %s"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                import mysql.connector.pooling
+                _pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name='ftp', pool_size=MYSQL_POOL_SIZE, option_files=MYSQL_CONFIG_FILE)
+    return _pool
+
+
+def db_query(query, params=()):
+    """Run a prepared statement on a pooled connection, returns all rows."""
+    import mysql.connector
+    try:
+        connection = get_db_pool().get_connection()
+    except mysql.connector.errors.PoolError:
+        # all pooled connections are busy, don't make the request wait
+        connection = mysql.connector.connect(option_files=MYSQL_CONFIG_FILE)
+    try:
+        cursor = connection.cursor(prepared=True)
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+    finally:
+        # returns pooled connections to the pool
+        connection.close()
+
+
+# lookups that hit mysql, docker or the disk are kept in memory for a while
+lookup_cache = TTLCache(maxsize=int(os.environ.get('FTP_CACHE_SIZE', 4096)),
+                        ttl=int(os.environ.get('FTP_CACHE_TTL', 60)))
+
+
+def query_current_username(user_id):
+    rows = db_query(QUERY_USERNAME_BY_ID, (user_id,))
+    if not rows:
+        return None
+    username = rows[0][0]
+    return username.decode('utf-8') if isinstance(username, (bytes, bytearray)) else username
+
+
+def get_current_username():
+    """OpenPanel username of the logged in user, the owner of its ftp accounts."""
+    user_id = session.get('user_id')
+    return lookup_cache.get(('username', user_id), lambda: query_current_username(user_id))
+
+
+def no_username_error():
+    # without a username the owner would be empty, which is the standalone users.list
+    return jsonify({'error': _('No OpenPanel user for this session')}), 403
+
+
+def get_cached_server_ip():
+    return lookup_cache.get(('server_ip',), get_server_ip)
+
+
+class FtpServiceError(Exception):
+    pass
+
+
+def ftp_control(ops, **kwargs):
+    """Send operations to the control socket of the container, see ftp_control.py."""
+    from modules import ftp_control as control
+    try:
+        return control.call(ops, **kwargs)
+    except (OSError, control.ControlError) as e:
+        raise FtpServiceError(str(e))
+
+
+def ftp_service_error(e):
+    return jsonify({'error': _('FTP service is not available: %(error)s', error=str(e))}), 503
+
+
+def load_ftp_accounts(path, owner):
+    try:
+        users = list(ftp_users.parse_users_list(path))
+    except FileNotFoundError:
+        users = []
+    # never send passwords or their hashes to the browser, options include
+    # the limits of the owner
+    return [{'username': user.name, 'folder': user.folder, 'uid': user.uid, 'gid': user.gid,
+             'options': dict(user.options)}
+            for user in users]
+
+
+def get_ftp_accounts(owner):
+    # keyed by the generation and stat() of the list, so it is only parsed
+    # again after it was written
+    path = ftp_users.list_path(owner)
+    version = ftp_users.list_version(path)
+    return lookup_cache.get(('accounts', owner, version), lambda: load_ftp_accounts(path, owner))
+
+
+@app.route('/ftp', methods=['GET'])
+@login_required_route
+def ftp():
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    return render_template('ftp.html', title=_('FTP'),
+                           ftp_accounts=get_ftp_accounts(current_username),
+                           server_ip=get_cached_server_ip())
+
+
+@app.route('/ftp/accounts', methods=['GET'])
+@login_required_route
+def ftp_accounts():
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    return jsonify({'accounts': get_ftp_accounts(current_username),
+                    'cache': lookup_cache.stats()})
+
+
+@app.route('/ftp/limits', methods=['GET'])
+@login_required_route
+def ftp_limits():
+    # set by the administrator, accounts can only have lower values
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    return jsonify(ftp_users.read_owner_conf(ftp_users.owner_conf_path(current_username)))
+
+
+# open sessions per ftp sub-user and the max_sessions of the current user
+@app.route('/ftp/sessions', methods=['GET'])
+@login_required_route
+def ftp_sessions():
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    try:
+        result = ftp_control([{'op': 'sessions', 'owner': current_username}])[0]
+    except FtpServiceError as e:
+        return ftp_service_error(e)
+    return jsonify(result)
+
+
+# transfer counters of the current user and its ftp sub-users, written by
+# ftp_xferlog.py in the container so no log is read here
+@app.route('/ftp/usage', methods=['GET'])
+@login_required_route
+def ftp_usage():
+    from modules.ftp_xferlog import read_usage
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    return jsonify(read_usage(current_username))
+
+
+# live logins and transfers of the current user's ftp sub-users as
+# server-sent events. One reader per panel process gets the events from the
+# container and hands them to every open page of their owner.
+FTP_EVENTS_KEEPALIVE = 15
+_event_hub = None
+_event_hub_lock = threading.Lock()
+
+
+def get_event_hub():
+    global _event_hub
+    if _event_hub is None:
+        with _event_hub_lock:
+            if _event_hub is None:
+                from modules.ftp_events import EventHub
+                _event_hub = EventHub()
+    return _event_hub
+
+
+@app.route('/ftp/events', methods=['GET'])
+@login_required_route
+def ftp_events():
+    from modules.ftp_events import format_sse
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    hub = get_event_hub()
+    subscription = hub.subscribe(current_username)
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            dropped = 0
+            while True:
+                event = subscription.get(FTP_EVENTS_KEEPALIVE)
+                if subscription.dropped != dropped:
+                    # too slow, the page should reload the usage
+                    dropped = subscription.dropped
+                    yield format_sse({'dropped': dropped}, 'dropped')
+                if event is None:
+                    # also notices closed connections
+                    yield ': keepalive\n\n'
+                else:
+                    yield format_sse(event)
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# disk usage and quotas of the current user and its ftp sub-users, written by
+# the quota scanner of ftp_xferlog.py
+@app.route('/ftp/quota', methods=['GET'])
+@login_required_route
+def ftp_quota():
+    from modules.ftp_quota import read_quota
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    return jsonify(read_quota(current_username))
+
+
+# random passwords for the account form and for imports, at most
+# FTP_PASSWORDS_MAX per request: /ftp/passwords?count=1&length=16
+FTP_PASSWORDS_MAX = 1000
+
+
+@app.route('/ftp/passwords', methods=['GET'])
+@login_required_route
+def ftp_passwords():
+    try:
+        count = int(request.args.get('count', 1))
+        length = int(request.args.get('length', ftp_users.PASSWORD_LENGTH))
+        if not 1 <= count <= FTP_PASSWORDS_MAX or not 8 <= length <= 128:
+            raise ValueError('out of range')
+    except ValueError:
+        return jsonify({'error': _('Invalid count or length')}), 400
+    response = jsonify({'passwords': ftp_users.generate_passwords(count, length)})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# strength of a password typed in the form, from 0 (very weak) to 4, posted
+# so it doesn't end up in access logs
+@app.route('/ftp/passwords/strength', methods=['POST'])
+@login_required_route
+def ftp_password_strength():
+    data = request.get_json(silent=True) or request.form.to_dict()
+    if not isinstance(data, dict):
+        return jsonify({'error': _('password is required')}), 400
+    password = data.get('password')
+    if not isinstance(password, str):
+        return jsonify({'error': _('password is required')}), 400
+    return jsonify(ftp_users.password_strength(password, str(data.get('username') or '')))
+
+
+# checks a new ftp sub-user while the form is typed in: valid and not
+# reserved username, not taken by any account of any user and a folder
+# inside the home directory. Usernames of all accounts are kept in memory
+# and only read again from the index after it changed.
+_account_names = None
+_account_names_lock = threading.Lock()
+
+
+def get_account_names():
+    global _account_names
+    if _account_names is None:
+        with _account_names_lock:
+            if _account_names is None:
+                from modules.ftp_index import AccountNames
+                _account_names = AccountNames()
+    return _account_names
+
+
+@app.route('/ftp/accounts/validate', methods=['GET'])
+@login_required_route
+def ftp_accounts_validate():
+    from modules.ftp_index import ERRORS as INDEX_ERRORS
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    try:
+        errors = get_account_names().check(request.args.get('username', ''), current_username,
+                                           request.args.get('folder') or None)
+    except INDEX_ERRORS as e:
+        return ftp_service_error(e)
+    return jsonify({'valid': not errors, 'errors': errors})
+
+
+# add, remove, change password and options (max_rate) of ftp sub-users. The
+# body is one operation or {"ops": [...]}, all of them are sent to the
+# control socket of the container in a single round trip.
+FTP_WRITE_OPS = ('add', 'remove', 'passwd', 'options')
+
+
+@app.route('/ftp/accounts', methods=['POST'])
+@login_required_route
+def ftp_accounts_change():
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    data = request.get_json(silent=True) or request.form.to_dict()
+    if not isinstance(data, dict):
+        return jsonify({'error': _('Invalid operation')}), 400
+    ops = data.get('ops') if isinstance(data.get('ops'), list) else [data]
+
+    for op in ops:
+        if not isinstance(op, dict) or op.get('op') not in FTP_WRITE_OPS:
+            return jsonify({'error': _('Invalid operation')}), 400
+        # users can only manage their own accounts and not pick an uid
+        op['owner'] = current_username
+        op.pop('uid', None)
+        op.pop('gid', None)
+
+    try:
+        results = ftp_control(ops)
+    except FtpServiceError as e:
+        return ftp_service_error(e)
+
+    for op, result in zip(ops, results):
+        if result.get('ok'):
+            log_user_action(current_username, 'FTP account {}: {}'.format(op['op'], op.get('username')))
+    return jsonify({'results': results})
+
+
+# bulk import, the whole batch is checked first and written at once or not
+# at all. Accepts {"accounts": [{"username", "password", "folder"}, ...]} or
+# users.list lines (name|password|folder), passwords can be crypt hashes.
+# Accounts without a password get a generated one, returned once.
+FTP_IMPORT_TIMEOUT = 600
+
+
+@app.route('/ftp/accounts/import', methods=['POST'])
+@login_required_route
+def ftp_accounts_import():
+    from modules.ftp_control import import_ops, fill_passwords
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and isinstance(data.get('accounts'), list):
+        ops = [dict(account, op='add') for account in data['accounts'] if isinstance(account, dict)]
+    else:
+        ops = import_ops(request.get_data(as_text=True).splitlines())
+
+    for op in ops:
+        op['owner'] = current_username
+        op.pop('uid', None)
+        op.pop('gid', None)
+    if not ops:
+        return jsonify({'error': _('No accounts to import')}), 400
+    generated = fill_passwords(ops)
+
+    try:
+        results = ftp_control(ops, timeout=FTP_IMPORT_TIMEOUT, atomic=True)
+    except FtpServiceError as e:
+        return ftp_service_error(e)
+
+    imported = all(result.get('ok') for result in results)
+    if imported:
+        log_user_action(current_username, 'Imported {} FTP accounts'.format(len(ops)))
+    errors = [dict(result, username=op.get('username')) for op, result in zip(ops, results)
+              if not result.get('ok') and not result.get('skipped')]
+    return jsonify({'imported': len(ops) if imported else 0, 'errors': errors,
+                    'passwords': generated if imported else {}}), 200 if imported else 400
+
+
+@app.route('/ftp/accounts/export', methods=['GET'])
+@login_required_route
+def ftp_accounts_export():
+    current_username = get_current_username()
+    if not current_username:
+        return no_username_error()
+    return jsonify({'accounts': get_ftp_accounts(current_username)})
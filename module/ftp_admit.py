@@ -0,0 +1,93 @@
+"""
+ftp_admit.py
+
+Session limits for vsftpd logins, run by pam_exec from the account stack
+of the PAM services:
+
+    account required pam_exec.so quiet /usr/bin/python3 -S ftp_admit.py /run/openpanel/ftp/control.sock
+
+Asks the control socket (ftp_control.py) if PAM_USER is below the
+max_sessions of the account and of its owner and exits 1 if not. Only json
+and socket are imported, every login waits for this. pam_exec passes no
+environment of vsftpd, so the socket is an argument of the PAM line.
+
+Logins are allowed when the control socket can not be reached, limits are
+not worth an outage. start_vsftpd.sh warns about that on startup with:
+
+    python3 ftp_admit.py --check /run/openpanel/ftp/control.sock
+"""
+import json
+import os
+import socket
+import sys
+import time
+
+
+SOCKET_PATH = '/run/openpanel/ftp/control.sock'
+TIMEOUT = 5
+
+
+def admit(username, path=SOCKET_PATH, timeout=TIMEOUT):
+    """Return (allowed, reason)."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'ops': [{'op': 'admit', 'username': username}]}).encode('utf-8') + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        result = json.loads(data.decode('utf-8'))['results'][0]
+    except (OSError, ValueError, KeyError, IndexError):
+        return True, None
+    finally:
+        sock.close()
+    return result.get('admit', True), result.get('reason')
+
+
+def check(path=SOCKET_PATH, timeout=TIMEOUT):
+    """Return None when the control socket answers within timeout seconds, or the error."""
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+            sock.sendall(b'{"ops": []}\n')
+            json.loads(sock.makefile('rb').readline().decode('utf-8'))['results']
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            error = e
+        finally:
+            sock.close()
+        # the socket may not be listening yet right after the container started
+        if time.monotonic() > deadline:
+            return error
+        time.sleep(0.2)
+
+
+def main(argv=None):
+    # ftp_admit.py [SOCKET [USERNAME]] or ftp_admit.py --check [SOCKET]
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == '--check':
+        path = argv[1] if len(argv) > 1 else SOCKET_PATH
+        error = check(path)
+        if error is not None:
+            print('Control socket %s can not be reached, logins are not limited: %s' % (path, error),
+                  file=sys.stderr)
+            return 1
+        return 0
+    path = argv[0] if argv else SOCKET_PATH
+    username = argv[1] if len(argv) > 1 else os.environ.get('PAM_USER', '')
+    allowed, reason = admit(username, path)
+    if not allowed:
+        print('Login refused: %s' % reason, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
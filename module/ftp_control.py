@@ -0,0 +1,514 @@
+"""
+ftp_control.py
+
+Control socket for FTP accounts, so the OpenPanel module doesn't need
+docker exec or a shell for every change.
+
+The server runs inside ftp_sync.py in the container and listens on a unix
+socket that is bind mounted to the host. Every request is one line of JSON
+with a list of operations, the response is one line of JSON with a result
+per operation:
+
+    {"ops": [{"op": "add", "owner": "stefan", "username": "ftp1",
+              "password": "secret", "folder": "/home/stefan/ftp1"},
+             {"op": "passwd", "owner": "stefan", "username": "ftp2", "password": "new"},
+             {"op": "remove", "owner": "stefan", "username": "ftp3"},
+             {"op": "list", "owner": "stefan"}]}
+
+    {"results": [{"ok": true}, {"ok": true}, {"ok": true},
+                 {"ok": true, "accounts": [...]}]}
+
+All operations of a request are written with one rewrite of every
+users.list they touch and applied to the accounts right away. With
+"atomic": true in the request nothing is written unless every operation
+is valid, which is what bulk imports use. The export operation returns
+the users.list lines of an owner, password hashes included.
+
+admit, sessions and inspect only read the vsftpd processes (see
+ftp_sessions.py), admit is asked by ftp_admit.py from PAM before every
+login.
+
+The client side is call(), used by module/ftp.py, or from a shell:
+
+    python3 ftp_control.py '[{"op": "list", "owner": "stefan"}]'
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import socketserver
+import threading
+from contextlib import ExitStack
+
+try:
+    from . import ftp_sessions, ftp_users
+except ImportError:
+    import ftp_sessions
+    import ftp_users
+
+
+SOCKET_PATH = '/run/openpanel/ftp/control.sock'
+TIMEOUT = 30
+
+
+class ControlError(Exception):
+    pass
+
+
+def account_info(user):
+    return {'username': user.name, 'folder': user.folder, 'uid': user.uid, 'gid': user.gid}
+
+
+class UsersFile:
+    """Lines of one users.list while a request is applied."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = ftp_users.read_lines(path)
+        self.index = {}
+        for i, line in enumerate(self.lines):
+            self.index.setdefault(line.split('|', 1)[0], i)
+        # line number -> plain text password, hashed before the file is written
+        self.passwords = {}
+
+    def find(self, name):
+        i = self.index.get(name)
+        if i is None:
+            raise ControlError('user %s does not exist' % name)
+        return i
+
+    def set_password(self, i, password):
+        if not password:
+            raise ControlError('password is required')
+        if not isinstance(password, str):
+            raise ControlError('password must be a string')
+        if '|' in password or '\n' in password:
+            raise ControlError('password can not contain | or a new line')
+        fields = self.lines[i].split('|')
+        fields[1] = '*'
+        self.lines[i] = '|'.join(fields)
+        self.passwords[i] = password
+
+    def remove(self, name):
+        i = self.find(name)
+        self.lines[i] = None
+        self.passwords.pop(i, None)
+        del self.index[name]
+
+    def output(self):
+        """Final lines, passwords are only hashed here so a failed batch costs no hashing."""
+        for i, password in self.passwords.items():
+            fields = self.lines[i].split('|')
+            fields[1] = ftp_users.password_hash(password)
+            self.lines[i] = '|'.join(fields)
+        self.passwords = {}
+        return [line for line in self.lines if line is not None]
+
+
+class AccountControl:
+    """Applies control operations to the users.list files and accounts."""
+
+    def __init__(self, sync):
+        self.sync = sync
+        self.tracker = ftp_sessions.SessionTracker()
+
+    def list_path(self, op):
+        try:
+            return ftp_users.list_path(op.get('owner') or '', self.sync.users_dir)
+        except ftp_users.InvalidUser as e:
+            raise ControlError(str(e))
+
+    def op_add(self, op, users, taken):
+        name = op.get('username') or ''
+        owner = op.get('owner') or ''
+        try:
+            ftp_users.check_username(name)
+        except ftp_users.InvalidUser as e:
+            raise ControlError(str(e))
+        if name in taken:
+            raise ControlError('user %s already exists' % name)
+        password = op.get('password') or ''
+        if not isinstance(password, str):
+            raise ControlError('password must be a string')
+        folder = op.get('folder') or ''
+        if owner and not folder:
+            # the folder is chowned to the account, never default to the whole home
+            raise ControlError('folder is required for user %s' % name)
+        try:
+            line = ftp_users.format_line(name, '*', folder, op.get('uid'), op.get('gid'),
+                                         self.options(op, name))
+            ftp_users.parse_line(line, owner)
+        except ftp_users.InvalidUser as e:
+            raise ControlError(str(e))
+        users.lines.append(line)
+        i = len(users.lines) - 1
+        try:
+            users.set_password(i, password)
+        except BaseException:
+            # never leave the line behind with the placeholder password
+            users.lines.pop()
+            raise
+        users.index[name] = i
+        taken.add(name)
+        return {}
+
+    def options(self, op, name):
+        options = op.get('options') or {}
+        if isinstance(options, str):
+            # key=value,key=value as in users.list, from import_ops
+            try:
+                options = dict(ftp_users.parse_options(options, name))
+            except ftp_users.InvalidUser as e:
+                raise ControlError(str(e))
+        if not isinstance(options, dict):
+            raise ControlError('options must be an object')
+        for key, value in options.items():
+            if key not in ftp_users.ACCOUNT_OPTIONS:
+                raise ControlError('unknown option %s' % key)
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise ControlError('%s for user %s must be a positive number' % (key, name))
+        return options
+
+    def op_options(self, op, users, taken):
+        # null or 0 removes an option, options that are not given are kept
+        name = op.get('username')
+        i = users.find(name)
+        fields = users.lines[i].split('|')
+        fields += [''] * (6 - len(fields))
+        options = dict(ftp_users.parse_options(fields[5], name))
+        options.update(self.options(op, name))
+        fields[5] = ftp_users.format_options(dict((k, v or 0) for k, v in options.items()))
+        users.lines[i] = '|'.join(fields).rstrip('|')
+        return {'options': dict(ftp_users.parse_options(fields[5], name))}
+
+    def op_limits(self, op, users, taken):
+        # owner.conf, only for OpenAdmin, limits that are not given are kept
+        owner = op.get('owner') or ''
+        if not owner:
+            raise ControlError('limits need an owner')
+        limits = op.get('limits')
+        if limits is None:
+            return {'limits': ftp_users.read_owner_conf(ftp_users.owner_conf_path(owner, self.sync.users_dir))}
+        if not isinstance(limits, dict):
+            raise ControlError('limits must be an object')
+        for key, value in limits.items():
+            if key not in ftp_users.OWNER_LIMITS:
+                raise ControlError('unknown limit %s' % key)
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise ControlError('%s must be a positive number' % key)
+        path = ftp_users.owner_conf_path(owner, self.sync.users_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        current = ftp_users.read_owner_conf(path)
+        current.update(limits)
+        current = dict((k, v) for k, v in current.items() if v)
+        ftp_users.write_atomic(path, ''.join('%s=%d\n' % item for item in sorted(current.items())),
+                               0o600, fsync=False)
+        return {'limits': current}
+
+    def op_remove(self, op, users, taken):
+        users.remove(op.get('username'))
+        taken.discard(op.get('username'))
+        return {}
+
+    def op_passwd(self, op, users, taken):
+        users.set_password(users.find(op.get('username')), op.get('password') or '')
+        return {}
+
+    def op_list(self, op, users, taken):
+        # from lines, so changes earlier in the same request are included
+        owner = op.get('owner') or ''
+        accounts = []
+        for line in users.lines:
+            try:
+                user = line and ftp_users.parse_line(line, owner)
+            except ftp_users.InvalidUser:
+                continue
+            if user:
+                accounts.append(account_info(user))
+        return {'accounts': accounts}
+
+    def op_export(self, op, users, taken):
+        # users.list lines with password hashes, for moving accounts to another server
+        if users.passwords:
+            raise ControlError('export can not follow changes in the same request')
+        return {'lines': [line for line in users.lines if line]}
+
+    def owner_limit(self, owner, key):
+        if not owner:
+            return 0
+        path = ftp_users.owner_conf_path(owner, self.sync.users_dir)
+        return ftp_users.read_owner_conf(path).get(key, 0)
+
+    def op_admit(self, op):
+        """
+        Called by pam_exec before a login: refuse it if the account or its
+        owner already has max_sessions sessions.
+        """
+        # self.sync.users is replaced, never changed, so no lock is needed
+        users = self.sync.users
+        user = users.get(op.get('username'))
+        if user is None:
+            return {'admit': True}
+        counts = ftp_sessions.count_sessions(ftp_sessions.read_sessions())
+
+        limit = dict(user.options).get('max_sessions', 0)
+        if limit and counts.get(user.name, 0) >= limit:
+            return {'admit': False, 'reason': 'user %s has %d sessions' % (user.name, limit)}
+        limit = self.owner_limit(user.owner, 'max_sessions')
+        if limit:
+            total = sum(count for name, count in counts.items()
+                        if name in users and users[name].owner == user.owner)
+            if total >= limit:
+                return {'admit': False, 'reason': 'owner %s has %d sessions' % (user.owner, limit)}
+        return {'admit': True}
+
+    def op_sessions(self, op):
+        """Sessions per account of an owner, or of all accounts without an owner."""
+        users = self.sync.users
+        owner = op.get('owner')
+        counts = ftp_sessions.count_sessions(ftp_sessions.read_sessions())
+        if owner is not None:
+            counts = dict((name, count) for name, count in counts.items()
+                          if name in users and users[name].owner == owner)
+        result = {'sessions': counts, 'total': sum(counts.values())}
+        if owner:
+            result['limit'] = self.owner_limit(owner, 'max_sessions')
+        return result
+
+    def op_inspect(self, op):
+        """
+        Sessions with their command and transfer rate. since is the version
+        of the previous answer, then only changes since are returned.
+        """
+        since = op.get('since')
+        if since is not None and not isinstance(since, int):
+            raise ControlError('since must be a version')
+        owner = op.get('owner')
+        users = None
+        if owner is not None:
+            users = set(name for name, user in self.sync.users.items() if user.owner == owner)
+        return self.tracker.snapshot(since, users)
+
+    def op_quota(self, op):
+        """
+        Sent by ftp_quota.py with all accounts over their quota: they get
+        write_enable=NO, which vsftpd only reads at the login, so every
+        session of an account that just went over is ended. stop has the
+        accounts that uploaded while over, their uploads are stopped again.
+        """
+        over = op.get('over')
+        if not isinstance(over, list):
+            raise ControlError('over must be a list of users')
+        stop = op.get('stop') or []
+        if not isinstance(stop, list):
+            raise ControlError('stop must be a list of users')
+        with self.sync.lock:
+            users = self.sync.users
+            provisioner = self.sync.provisioner
+            over = set(name for name in over if name in users)
+            changed = over ^ provisioner.read_only
+            provisioner.read_only = over
+            provisioner.write_user_configs(dict((name, users[name]) for name in changed))
+        stopped = ftp_sessions.end_sessions(over & changed, over & set(stop))
+        return {'changed': sorted(changed), 'stopped': stopped}
+
+    # operations without a users.list, admit must not wait for the lock
+    # during big imports
+    STATE_OPS = {
+        'admit': op_admit,
+        'sessions': op_sessions,
+        'inspect': op_inspect,
+        'quota': op_quota,
+    }
+
+    OPS = {
+        'add': op_add,
+        'remove': op_remove,
+        'passwd': op_passwd,
+        'list': op_list,
+        'export': op_export,
+        'options': op_options,
+        'limits': op_limits,
+    }
+    WRITE_OPS = ('add', 'remove', 'passwd', 'options')
+
+    def run(self, ops, atomic=False):
+        """
+        Run a batch of operations, returns one result per operation.
+
+        With atomic, nothing is written unless every operation is valid,
+        the operations that were fine are reported as not applied.
+        """
+        if ops and all(isinstance(op, dict) and op.get('op') in self.STATE_OPS for op in ops):
+            return [self.run_session_op(op) for op in ops]
+
+        results = []
+        files = {}      # path -> UsersFile, read once per request
+        changed = set()
+        resync = set()  # lists with new owner.conf limits
+        # every list stays locked from the first read until it was written
+        with self.sync.lock, ExitStack() as locks:
+            taken = set(self.sync.users)
+            for op in ops:
+                if isinstance(op, dict) and op.get('op') in self.STATE_OPS:
+                    results.append(self.run_session_op(op))
+                    continue
+                try:
+                    if not isinstance(op, dict) or op.get('op') not in self.OPS:
+                        raise ControlError('unknown operation')
+                    if atomic and op['op'] == 'limits':
+                        # owner.conf is written right away
+                        raise ControlError('limits can not be part of an atomic batch')
+                    path = self.list_path(op)
+                    if path not in files:
+                        locks.enter_context(ftp_users.locked(path))
+                        files[path] = UsersFile(path)
+                    result = self.OPS[op['op']](self, op, files[path], taken)
+                    if op['op'] in self.WRITE_OPS:
+                        changed.add(path)
+                    elif op['op'] == 'limits' and op.get('limits') is not None:
+                        resync.add(path)
+                    result['ok'] = True
+                except ControlError as e:
+                    result = {'ok': False, 'error': str(e)}
+                except (TypeError, AttributeError, ValueError):
+                    result = {'ok': False, 'error': 'invalid operation'}
+                except Exception as e:
+                    # one broken operation must not take the others of the request down
+                    result = {'ok': False, 'error': 'operation failed: %s' % e}
+                results.append(result)
+
+            if atomic and not all(result['ok'] for result in results):
+                return [result if not result['ok'] else
+                        {'ok': False, 'skipped': True, 'error': 'not applied, the batch has errors'}
+                        for result in results]
+
+            for path in changed:
+                ftp_users.write_lines(path, files[path].output())
+            if changed or resync:
+                self.sync.sync(changed | resync)
+        return results
+
+    def run_session_op(self, op):
+        try:
+            if op.get('owner'):
+                self.list_path(op)
+            result = self.STATE_OPS[op['op']](self, op)
+            result['ok'] = True
+        except ControlError as e:
+            result = {'ok': False, 'error': str(e)}
+        except (TypeError, AttributeError, ValueError):
+            result = {'ok': False, 'error': 'invalid operation'}
+        except Exception as e:
+            result = {'ok': False, 'error': 'operation failed: %s' % e}
+        return result
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                ops = request.get('ops') if isinstance(request, dict) else None
+                if not isinstance(ops, list):
+                    raise ValueError('ops must be a list')
+                response = {'results': self.server.control.run(ops, bool(request.get('atomic')))}
+            except ValueError as e:
+                response = {'error': 'invalid request: %s' % e}
+            except Exception as e:
+                response = {'error': 'request failed: %s' % e}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(sync, path=SOCKET_PATH):
+    """Listen on path from a daemon thread."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = ControlServer(path, ControlHandler)
+    server.control = AccountControl(sync)
+    os.chmod(path, 0o660)
+    thread = threading.Thread(target=server.serve_forever, name='control', daemon=True)
+    thread.start()
+    return server
+
+
+def import_ops(lines, owner=''):
+    """add operations for users.list formatted lines, as exported or from a migration."""
+    ops = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('|')
+        fields += [''] * (6 - len(fields))
+        op = {'op': 'add', 'owner': owner, 'username': fields[0],
+              'password': fields[1], 'folder': fields[2]}
+        if fields[3]:
+            op['uid'] = fields[3]
+        if fields[4]:
+            op['gid'] = fields[4]
+        if fields[5]:
+            op['options'] = fields[5]
+        ops.append(op)
+    return ops
+
+
+def fill_passwords(ops):
+    """
+    Give add operations without a password a generated one, all of them
+    from one batch. Returns username -> generated password, to show once.
+    """
+    missing = [op for op in ops if op.get('op') == 'add' and not op.get('password')]
+    generated = {}
+    for op, password in zip(missing, ftp_users.generate_passwords(len(missing))):
+        op['password'] = password
+        generated[op.get('username')] = password
+    return generated
+
+
+def call(ops, path=SOCKET_PATH, timeout=TIMEOUT, atomic=False):
+    """Send a batch of operations to the control socket, returns the results."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'ops': ops, 'atomic': atomic}).encode('utf-8') + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    response = json.loads(data.decode('utf-8'))
+    if 'error' in response:
+        raise ControlError(response['error'])
+    return response['results']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Send operations to the FTP control socket.')
+    parser.add_argument('--socket', default=os.environ.get('CONTROL_SOCKET', SOCKET_PATH),
+                        help='control socket (default: %(default)s)')
+    parser.add_argument('ops', help='JSON list of operations, for example \'[{"op": "list", "owner": "stefan"}]\'')
+    parser.add_argument('--atomic', action='store_true', help='apply all operations or none')
+    args = parser.parse_args(argv)
+
+    results = call(json.loads(args.ops), args.socket, atomic=args.atomic)
+    print(json.dumps(results, indent=2))
+    return 0 if all(result.get('ok') for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
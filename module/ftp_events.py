@@ -0,0 +1,169 @@
+"""
+ftp_events.py
+
+Live transfer events for the OpenPanel module.
+
+Inside the container ftp_xferlog.py feeds every parsed log line to an
+EventPublisher, which writes logins and transfers as lines of JSON to
+everyone connected to the unix socket /run/openpanel/ftp/events.sock:
+
+    {"time": 1792200000, "user": "ftp1", "owner": "stefan", "action": "UPLOAD",
+     "result": "OK", "client": "1.2.3.4", "path": "/home/stefan/ftp1/f",
+     "bytes": 1048576, "rate": 5120.0}
+
+In the panel every process has one EventHub with a single reader thread
+for the socket, browsers subscribe to the events of their owner and get
+them from a queue of their own (see /ftp/events in ftp.py). The log is
+parsed once, however many pages are open.
+"""
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+
+SOCKET_PATH = '/run/openpanel/ftp/events.sock'
+ACTIONS = ('LOGIN', 'UPLOAD', 'DOWNLOAD', 'DELETE', 'MKDIR', 'RMDIR', 'RENAME')
+# events waiting for a browser, new ones are dropped while it is too slow
+QUEUE_SIZE = 256
+# seconds between connection attempts of the hub
+RECONNECT = 5
+
+
+class EventPublisher:
+    """Writes events to every connected subscriber, a sink of ftp_xferlog.py."""
+
+    def __init__(self, path=SOCKET_PATH, owner_of=None):
+        self.path = path
+        self.owner_of = owner_of    # ftp user -> owner
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def serve(self):
+        """Listen on the socket from a daemon thread."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o660)
+        server.listen(16)
+        thread = threading.Thread(target=self.accept, args=(server,), name='events', daemon=True)
+        thread.start()
+        return server
+
+    def accept(self, server):
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            # the log must never wait for a subscriber
+            conn.setblocking(False)
+            with self.lock:
+                self.subscribers.append(conn)
+
+    def add(self, event):
+        if not event.user or event.action not in ACTIONS or not self.subscribers:
+            return
+        owner = self.owner_of(event.user) if self.owner_of else None
+        data = json.dumps({
+            'time': event.time, 'user': event.user, 'owner': owner or '',
+            'action': event.action, 'result': event.result, 'client': event.client,
+            'path': event.path, 'bytes': event.bytes, 'rate': event.rate,
+        }).encode('utf-8') + b'\n'
+        with self.lock:
+            for conn in list(self.subscribers):
+                try:
+                    if conn.send(data) == len(data):
+                        continue
+                except OSError:
+                    pass
+                # gone, or so slow that its buffer is full: it reconnects
+                self.subscribers.remove(conn)
+                conn.close()
+
+
+class Subscription:
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.dropped = 0
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout):
+        """The next event, or None after timeout seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    """
+    Reads the events socket in one thread and hands every event to the
+    subscriptions of its owner.
+    """
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+        self.subscriptions = {}     # owner -> set of Subscription
+        self.lock = threading.Lock()
+        self.thread = None
+        self.connected = False
+
+    def subscribe(self, owner):
+        subscription = Subscription(owner)
+        with self.lock:
+            self.subscriptions.setdefault(owner, set()).add(subscription)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='ftp-events', daemon=True)
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.owner)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.owner]
+
+    def dispatch(self, line):
+        try:
+            event = json.loads(line.decode('utf-8'))
+            owner = event['owner']
+        except (ValueError, KeyError, TypeError):
+            return
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(owner, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def run(self):
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                    conn.connect(self.path)
+                    self.connected = True
+                    for line in conn.makefile('rb'):
+                        self.dispatch(line)
+            except OSError:
+                pass
+            self.connected = False
+            time.sleep(RECONNECT)
+
+
+def format_sse(event, name='transfer'):
+    """An event as a server-sent events message."""
+    return 'event: %s\ndata: %s\n\n' % (name, json.dumps(event))
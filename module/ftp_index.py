@@ -0,0 +1,262 @@
+"""
+ftp_index.py
+
+SQLite index of the FTP accounts of all OpenPanel users, so the admin page
+and username checks don't have to walk and parse every users.list.
+
+ftp_sync.py in the container owns the index: it is rebuilt on start and on
+SIGHUP and after that only the accounts that were added, changed or
+removed are written. The OpenPanel and OpenAdmin modules open it read-only
+through the users volume:
+
+    /etc/openpanel/ftp/users/index.db
+
+The index holds the accounts that are applied, so for a username defined
+in more than one list it has the same owner as the system account.
+ftp_xferlog.py adds the transfer counters, last login and disk usage of
+every account, so the admin listing can search, sort and page through all
+of them.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from . import ftp_users
+except ImportError:
+    import ftp_users
+
+
+INDEX_NAME = 'index.db'
+# readers wait this long while ftp_sync.py writes
+TIMEOUT = 10
+
+# bump SCHEMA_VERSION when the tables change, the index is dropped and
+# built again on the next start of ftp_sync.py
+SCHEMA_VERSION = 3
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (
+    username TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uid INTEGER,
+    gid INTEGER,
+    updated INTEGER NOT NULL,
+    quota INTEGER NOT NULL DEFAULT 0,
+    -- transfer counters and disk usage, written by ftp_xferlog.py
+    bytes_in INTEGER NOT NULL DEFAULT 0,
+    bytes_out INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    last_login INTEGER NOT NULL DEFAULT 0,
+    last_transfer INTEGER NOT NULL DEFAULT 0,
+    disk_used INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS accounts_owner ON accounts (owner, username);
+CREATE INDEX IF NOT EXISTS accounts_folder ON accounts (folder, username);
+CREATE INDEX IF NOT EXISTS accounts_last_login ON accounts (last_login, username);
+CREATE INDEX IF NOT EXISTS accounts_bytes ON accounts (bytes, username);
+CREATE INDEX IF NOT EXISTS accounts_disk_used ON accounts (disk_used, username);
+'''
+
+# what opening or writing the index can raise
+ERRORS = (sqlite3.Error, OSError)
+
+COLUMNS = ('username', 'owner', 'folder', 'uid', 'gid', 'updated', 'quota',
+           'bytes_in', 'bytes_out', 'bytes', 'last_login', 'last_transfer', 'disk_used')
+SELECT = 'SELECT %s FROM accounts' % ', '.join(COLUMNS)
+
+# sort keys of search(), all of them have an index that ends in username
+SORTS = ('username', 'owner', 'folder', 'last_login', 'bytes', 'disk_used')
+SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 1000
+
+
+def prefix_range(prefix):
+    """Bounds for a prefix match that can use an index, unlike LIKE."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def index_path(users_dir=ftp_users.USERS_DIR):
+    return os.path.join(users_dir, INDEX_NAME)
+
+
+class AccountIndex:
+    """Account lookups by username and owner, see the module docstring."""
+
+    def __init__(self, path=None, readonly=False):
+        self.path = path or index_path()
+        if readonly:
+            self.db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True,
+                                      timeout=TIMEOUT, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(self.path, timeout=TIMEOUT, check_same_thread=False)
+            # readers on the host don't block the writer in the container
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            with self.db:
+                if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                    self.db.execute('DROP TABLE IF EXISTS accounts')
+                self.db.executescript(SCHEMA)
+                self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            os.chmod(self.path, 0o640)
+
+    def close(self):
+        self.db.close()
+
+    def rows(self, users, ids=None):
+        now = int(time.time())
+        ids = ids or {}
+        for user in users.values():
+            uid, gid = ids.get(user.name, (user.uid, user.gid))
+            yield (user.name, user.owner, user.folder, uid, gid, now, dict(user.options).get('quota', 0))
+
+    # the counters of an account are kept when its other columns change
+    UPSERT = (
+        'INSERT INTO accounts (username, owner, folder, uid, gid, updated, quota) VALUES (?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (username) DO UPDATE SET owner = excluded.owner, folder = excluded.folder, '
+        'uid = excluded.uid, gid = excluded.gid, updated = excluded.updated, quota = excluded.quota'
+    )
+
+    def replace_all(self, users, ids=None):
+        """Replace the whole index with users, a dict of FtpUser."""
+        with self.db:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS keep (username TEXT PRIMARY KEY)')
+            self.db.execute('DELETE FROM keep')
+            self.db.executemany('INSERT INTO keep VALUES (?)', ((name,) for name in users))
+            self.db.execute('DELETE FROM accounts WHERE username NOT IN (SELECT username FROM keep)')
+            self.db.executemany(self.UPSERT, self.rows(users, ids))
+
+    def update(self, changed, removed, ids=None):
+        """Write the changed FtpUser dict and drop the removed names."""
+        with self.db:
+            self.db.executemany('DELETE FROM accounts WHERE username = ?', ((name,) for name in removed))
+            self.db.executemany(self.UPSERT, self.rows(changed, ids))
+
+    def write_usage(self, users):
+        """Store transfer counters, users is a dict of name -> counters as in usage.json."""
+        with self.db:
+            self.db.executemany(
+                'UPDATE accounts SET bytes_in = ?, bytes_out = ?, bytes = ?, last_login = ?, last_transfer = ? '
+                'WHERE username = ?',
+                ((c['bytes_in'], c['bytes_out'], c['bytes_in'] + c['bytes_out'],
+                  int(c['last_login'] or 0), int(c['last_transfer'] or 0), name)
+                 for name, c in users.items()))
+
+    def write_disk_usage(self, users):
+        """Store bytes used per account, users is a dict of name -> bytes."""
+        with self.db:
+            self.db.executemany('UPDATE accounts SET disk_used = ? WHERE username = ? AND disk_used != ?',
+                                ((used, name, used) for name, used in users.items()))
+
+    def all_accounts(self):
+        rows = self.db.execute('SELECT username, owner, folder, quota FROM accounts')
+        return [dict(zip(('username', 'owner', 'folder', 'quota'), row)) for row in rows]
+
+    def get(self, username):
+        row = self.db.execute(SELECT + ' WHERE username = ?', (username,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def owners(self):
+        """Owners with at least one account and how many they have."""
+        return dict(self.db.execute('SELECT owner, COUNT(*) FROM accounts GROUP BY owner ORDER BY owner'))
+
+    def search(self, username='', owner='', folder='', sort='username', descending=False,
+               after=None, limit=SEARCH_LIMIT):
+        """
+        One page of accounts whose username, owner and folder start with the
+        given prefixes, ordered by sort and then username.
+
+        Pages use keyset pagination: pass the cursor of the last page as
+        after, which is (sort value, username) of its last row. Returns
+        (accounts, cursor), cursor is None on the last page.
+        """
+        if sort not in SORTS:
+            raise ValueError('can not sort by %s' % sort)
+        limit = max(1, min(int(limit), MAX_SEARCH_LIMIT))
+        where, params = [], []
+        for column, prefix in (('username', username), ('owner', owner), ('folder', folder)):
+            if prefix:
+                where.append('%s >= ? AND %s < ?' % (column, column))
+                params.extend(prefix_range(prefix))
+        if after is not None:
+            if sort == 'username':
+                where.append('username %s ?' % ('<' if descending else '>'))
+                params.append(after[1])
+            else:
+                where.append('(%s, username) %s (?, ?)' % (sort, '<' if descending else '>'))
+                params.extend(after)
+
+        query = SELECT
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        direction = 'DESC' if descending else 'ASC'
+        if sort == 'username':
+            query += ' ORDER BY username %s' % direction
+        else:
+            query += ' ORDER BY %s %s, username %s' % (sort, direction, direction)
+        query += ' LIMIT ?'
+        params.append(limit + 1)
+
+        accounts = [dict(zip(COLUMNS, row)) for row in self.db.execute(query, params)]
+        cursor = None
+        if len(accounts) > limit:
+            accounts = accounts[:limit]
+            cursor = (accounts[-1][sort], accounts[-1]['username'])
+        return accounts, cursor
+
+
+class AccountNames:
+    """
+    Usernames and uids of all accounts in memory, for checks that must be
+    fast enough to run on every key press. The sets are only read again
+    when the index was written since, PRAGMA data_version tells without
+    reading any table.
+    """
+
+    def __init__(self, path=None):
+        self.index = AccountIndex(path, readonly=True)
+        self.lock = threading.Lock()
+        self.version = None
+        self.owners = {}        # username -> owner
+        self.uids = {}          # uid -> owners with accounts that use it
+
+    def refresh(self):
+        with self.lock:
+            version = self.index.db.execute('PRAGMA data_version').fetchone()[0]
+            if version == self.version:
+                return
+            owners = {}
+            uids = {}
+            for username, owner, uid in self.index.db.execute('SELECT username, owner, uid FROM accounts'):
+                owners[username] = owner
+                if uid is not None:
+                    uids.setdefault(uid, set()).add(owner)
+            self.owners, self.uids, self.version = owners, uids, version
+
+    def check(self, username, owner, folder=None, uid=None):
+        """
+        Errors of a new account of owner by field, empty when it can be
+        added. folder and uid are only checked when they are given.
+        """
+        self.refresh()
+        errors = {}
+        try:
+            ftp_users.check_username(username)
+            if username in self.owners:
+                raise ftp_users.InvalidUser('user %s already exists' % username)
+        except ftp_users.InvalidUser as e:
+            errors['username'] = str(e)
+        if folder is not None:
+            try:
+                ftp_users.check_folder(username, folder, owner)
+            except ftp_users.InvalidUser as e:
+                errors['folder'] = str(e)
+        if uid is not None:
+            if not ftp_users.FIRST_UID <= uid <= ftp_users.LAST_UID:
+                # the provisioner skips these accounts
+                errors['uid'] = 'uid %d is outside %d-%d' % (uid, ftp_users.FIRST_UID, ftp_users.LAST_UID)
+            elif self.uids.get(uid, set()) - {owner}:
+                # files of another owner's accounts would belong to this one
+                errors['uid'] = 'uid %d is used by another user' % uid
+        return errors
@@ -0,0 +1,159 @@
+"""
+ftp_metrics.py
+
+Prometheus metrics for the FTP container.
+
+Counters are fed by the vsftpd log events from ftp_xferlog.py, gauges are
+read from /proc when a scrape comes in. The exporter runs inside the
+ftp_xferlog.py process:
+
+    python3 ftp_xferlog.py --metrics-port 9120
+    curl http://127.0.0.1:9120/metrics
+"""
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+PREFIX = 'openpanel_ftp_'
+FTP_PORT = 21
+# transfer duration buckets in seconds
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+
+TCP_ESTABLISHED = '01'
+TCP_LISTEN = '0A'
+
+
+def read_sockets(paths=('/proc/net/tcp', '/proc/net/tcp6')):
+    """Yield (local port, state) for all TCP sockets."""
+    for path in paths:
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    yield int(fields[1].rsplit(':', 1)[1], 16), fields[3]
+        except (FileNotFoundError, StopIteration):
+            continue
+
+
+def count_processes(name='vsftpd'):
+    count = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/comm' % pid) as f:
+                if f.read().strip() == name:
+                    count += 1
+        except OSError:
+            continue
+    return count
+
+
+class Metrics:
+    """Counters and histograms, updated with add(event) from the log."""
+
+    def __init__(self, min_port=None, max_port=None):
+        self.min_port = min_port
+        self.max_port = max_port
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.logins = {'ok': 0, 'fail': 0}
+        self.bytes = {'in': 0, 'out': 0}
+        self.files = {'in': 0, 'out': 0}
+        self.failed_transfers = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.duration_sum = 0.0
+
+    def add(self, event):
+        with self.lock:
+            if event.action == 'CONNECT':
+                self.connections += 1
+            elif event.action == 'LOGIN':
+                self.logins['ok' if event.ok else 'fail'] += 1
+            elif event.action in ('UPLOAD', 'DOWNLOAD'):
+                if not event.ok:
+                    self.failed_transfers += 1
+                    return
+                direction = 'in' if event.action == 'UPLOAD' else 'out'
+                self.bytes[direction] += event.bytes
+                self.files[direction] += 1
+                duration = event.duration
+                self.buckets[bisect.bisect_left(BUCKETS, duration)] += 1
+                self.duration_sum += duration
+
+    def gauges(self):
+        """Active sessions and passive ports in use, from /proc/net/tcp."""
+        sessions = passive = 0
+        for port, state in read_sockets():
+            if port == FTP_PORT and state == TCP_ESTABLISHED:
+                sessions += 1
+            elif (self.min_port is not None and self.min_port <= port <= self.max_port
+                  and state in (TCP_ESTABLISHED, TCP_LISTEN)):
+                passive += 1
+        return sessions, passive
+
+    def render(self):
+        sessions, passive = self.gauges()
+        processes = count_processes()
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append('# HELP %s%s %s' % (PREFIX, name, help_text))
+            out.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            for labels, value in samples:
+                out.append('%s%s%s %s' % (PREFIX, name, labels, value))
+
+        with self.lock:
+            metric('sessions', 'gauge', 'Established control connections.', [('', sessions)])
+            metric('passive_ports_in_use', 'gauge', 'Sockets in the passive port range.', [('', passive)])
+            if self.max_port is not None:
+                metric('passive_ports', 'gauge', 'Size of the passive port range.',
+                       [('', self.max_port - self.min_port + 1)])
+            metric('processes', 'gauge', 'Running vsftpd processes.', [('', processes)])
+            metric('connections_total', 'counter', 'Accepted connections.', [('', self.connections)])
+            metric('logins_total', 'counter', 'Login attempts.',
+                   [('{result="%s"}' % k, v) for k, v in sorted(self.logins.items())])
+            metric('transfer_bytes_total', 'counter', 'Transferred bytes, in is upload.',
+                   [('{direction="%s"}' % k, v) for k, v in sorted(self.bytes.items())])
+            metric('transfer_files_total', 'counter', 'Transferred files, in is upload.',
+                   [('{direction="%s"}' % k, v) for k, v in sorted(self.files.items())])
+            metric('transfer_failures_total', 'counter', 'Failed uploads and downloads.',
+                   [('', self.failed_transfers)])
+
+            samples = []
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), self.buckets):
+                cumulative += count
+                samples.append(('_bucket{le="%s"}' % bound, cumulative))
+            samples.append(('_sum', '%.3f' % self.duration_sum))
+            samples.append(('_count', cumulative))
+            metric('transfer_duration_seconds', 'histogram', 'Duration of transfers.', samples)
+
+        return '\n'.join(out) + '\n'
+
+
+def serve(metrics, address='', port=9120):
+    """Serve /metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,158 @@
+"""
+ftp_pasv.py
+
+Recommends the size of the passive port pool from the vsftpd log.
+
+Every passive transfer holds one port from MIN_PORT-MAX_PORT, so the pool
+has to be larger than the highest number of transfers running at the same
+time. Directory listings also use a passive port but are not logged, which
+is what the headroom factor is for.
+
+    docker logs --since 24h openadmin_ftp 2>&1 | python3 ftp_pasv.py
+
+Scripts can read the value with:
+
+    MAX_PORT=$(python3 ftp_pasv.py --print-max-port < vsftpd.log)
+
+To apply it, set the range in the env file that setup.sh uses for the
+container, the firewall and the port mapping, then run setup.sh again.
+Only MIN_PORT and MAX_PORT are replaced, other settings of the file stay:
+
+    docker logs --since 24h openadmin_ftp 2>&1 | python3 ftp_pasv.py --env-file /etc/openpanel/ftp/ftp.env
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from collections import defaultdict
+
+import ftp_users
+import ftp_xferlog
+
+
+DEFAULT_MIN_PORT = 21000
+HEADROOM = 4
+MIN_POOL = 20
+# keep clear of the ephemeral port range of the host
+MAX_PORT_LIMIT = 32767
+
+
+def peak_transfers(events):
+    """Return (count, time) for the highest number of concurrent transfers."""
+    # +1 when a transfer starts and -1 after it ended, per second
+    changes = defaultdict(int)
+    for event in ftp_xferlog.transfers(events):
+        end = int(event.time)
+        start = end - int(math.ceil(event.duration))
+        changes[start] += 1
+        changes[end + 1] -= 1
+
+    peak, peak_time, current = 0, None, 0
+    for second in sorted(changes):
+        current += changes[second]
+        if current > peak:
+            peak, peak_time = current, second
+    return peak, peak_time
+
+
+def recommend(peak, headroom=HEADROOM):
+    """Pool size for a peak of concurrent transfers, rounded up to tens."""
+    size = max(MIN_POOL, int(math.ceil(peak * headroom)))
+    return int(math.ceil(size / 10.0)) * 10
+
+
+def read_env_file(path):
+    """KEY=value settings of an env file as a dict, empty for a missing file."""
+    values = {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                key, sep, value = line.partition('=')
+                key = key.strip()
+                if key.startswith('export '):
+                    key = key[len('export '):].strip()
+                if sep and not key.startswith('#'):
+                    values.setdefault(key, value.strip())
+    except FileNotFoundError:
+        pass
+    return values
+
+
+def update_env_file(path, values):
+    """
+    Set the keys of values in an env file, every other line is kept. Keys
+    that are set more than once only keep their first line.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+    output = []
+    done = set()
+    for line in lines:
+        key = line.split('=', 1)[0].strip()
+        if key.startswith('export '):
+            key = key[len('export '):].strip()
+        if '=' in line and key in values:
+            if key not in done:
+                output.append('%s=%s' % (key, values[key]))
+                done.add(key)
+            continue
+        output.append(line)
+    output += ['%s=%s' % (key, value) for key, value in values.items() if key not in done]
+    ftp_users.write_atomic(path, ''.join(line + '\n' for line in output))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recommend a passive port range from the vsftpd log.')
+    parser.add_argument('log', nargs='?', type=argparse.FileType('r', errors='replace'), default=sys.stdin,
+                        help='vsftpd log, read from stdin by default')
+    parser.add_argument('--min-port', type=int,
+                        help='first passive port (default: MIN_PORT of the env file or environment, or %d)'
+                        % DEFAULT_MIN_PORT)
+    parser.add_argument('--headroom', type=float, default=HEADROOM,
+                        help='ports per concurrent transfer (default: %(default)s)')
+    parser.add_argument('--env', action='store_true',
+                        help='only print MIN_PORT and MAX_PORT for the env file')
+    parser.add_argument('--print-max-port', action='store_true',
+                        help='only print the recommended MAX_PORT, for scripts')
+    parser.add_argument('--env-file', metavar='PATH',
+                        help='set MIN_PORT and MAX_PORT in this env file, keeping its other settings')
+    args = parser.parse_args(argv)
+    if args.min_port is None:
+        current = read_env_file(args.env_file) if args.env_file else {}
+        args.min_port = int(current.get('MIN_PORT') or os.environ.get('MIN_PORT', DEFAULT_MIN_PORT))
+
+    peak, peak_time = peak_transfers(ftp_xferlog.parse(args.log))
+    size = recommend(peak, args.headroom)
+    max_port = min(args.min_port + size - 1, MAX_PORT_LIMIT)
+
+    if args.env_file:
+        update_env_file(args.env_file, {'MIN_PORT': args.min_port, 'MAX_PORT': max_port})
+        print('MIN_PORT=%d MAX_PORT=%d written to %s' % (args.min_port, max_port, args.env_file), file=sys.stderr)
+        return 0
+    # stdout only has the values, anything else goes to stderr
+    if args.print_max_port:
+        print(max_port)
+        return 0
+    if args.env:
+        print('MIN_PORT=%d' % args.min_port)
+        print('MAX_PORT=%d' % max_port)
+        return 0
+
+    if peak_time is not None:
+        print('Peak concurrent transfers: %d at %s UTC' % (
+            peak, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(peak_time))))
+    else:
+        print('No transfers found in the log')
+    if 'MAX_PORT' in os.environ:
+        current = int(os.environ['MAX_PORT']) - int(os.environ.get('MIN_PORT', DEFAULT_MIN_PORT)) + 1
+        print('Current pool: %d ports' % current)
+    print('Recommended pool: %d ports, MIN_PORT=%d MAX_PORT=%d' % (max_port - args.min_port + 1, args.min_port, max_port))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,396 @@
+"""
+ftp_provision.py
+
+Creates the system accounts for all FTP sub-users in one pass.
+
+All users.list files are parsed once, the new /etc/passwd, /etc/shadow and
+/etc/group are built in memory and written with a single atomic rename per
+file, then the home folders are created and chowned in a batched pass.
+Nothing is forked per user.
+
+With --mode virtual the FTP users are not system accounts at all: their
+password hashes go into a Berkeley DB that vsftpd reads through pam_userdb,
+and every user gets a file in user_config_dir with its folder. Only one
+guest account per uid is added to /etc/passwd.
+
+Used by start_vsftpd.sh inside the docker image:
+
+    python3 ftp_provision.py [--mode local|virtual] [--users-dir DIR] [--root DIR]
+
+Passwords that are already hashed in users.list are used as they are, so
+nothing has to be hashed on boot. To hash existing plaintext passwords once:
+
+    python3 ftp_provision.py --migrate
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import ftp_users
+
+
+class Provisioner:
+    """Builds the account tables under root from a dict of FtpUser."""
+
+    # vsftpd user_config_dir, a file per user with settings like its rate
+    USER_CONFIG_DIR = '/etc/vsftpd/users'
+    # account options to vsftpd settings
+    CONFIG_OPTIONS = {'max_rate': 'local_max_rate'}
+
+    def __init__(self, root='/', log=print):
+        self.root = root
+        self.log = log
+        # name -> (uid, gid) of the accounts that were created
+        self.ids = {}
+        # accounts over their quota, they can only download (see ftp_quota.py)
+        self.read_only = set()
+
+    def path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def read_tables(self):
+        return (ftp_users.read_table(self.path('/etc/passwd')),
+                ftp_users.read_table(self.path('/etc/shadow')),
+                ftp_users.read_table(self.path('/etc/group')))
+
+    def build(self, users, passwd, shadow, group, remove=None, keep_hashes=(), all_users=None):
+        """
+        Return the new passwd, shadow and group rows plus the list of
+        (folder, uid, gid) to create.
+
+        The FTP accounts named in remove are dropped before users are added,
+        by default every account created by a previous run. System accounts
+        are kept as they are. Users named in keep_hashes keep the password
+        hash they already have in shadow instead of being hashed again.
+        all_users has the owners of the accounts that are kept, users by default.
+        """
+        managed = set(row[0] for row in passwd if ftp_users.is_managed(row))
+        if remove is not None:
+            managed &= set(remove)
+        old_hashes = dict((row[0], row[1]) for row in shadow if row[0] in keep_hashes)
+        # accounts that are added again keep their uid and own group, the
+        # files in their folder are owned by them
+        old_uids = dict((row[0], int(row[2])) for row in passwd if row[0] in managed and row[2].isdigit())
+        old_gids = dict((row[0], int(row[2])) for row in group if row[0] in managed and row[2].isdigit())
+
+        passwd = [row for row in passwd if row[0] not in managed]
+        shadow = [row for row in shadow if row[0] not in managed]
+        group = [row for row in group if row[0] not in managed]
+        for row in group:
+            if len(row) > 3 and row[3]:
+                row[3] = ','.join(m for m in row[3].split(',') if m not in managed)
+
+        system_names = set(row[0] for row in passwd)
+        group_names = set(row[0] for row in group)
+        used_uids = set(int(row[2]) for row in passwd if row[2].isdigit())
+        # owners of the accounts on every uid, None for system accounts. An
+        # explicit uid must not give an account the files of another owner
+        owner_of = dict((name, user.owner) for name, user in (all_users or users).items())
+        uid_owners = {}
+        for row in passwd:
+            if row[2].isdigit():
+                owner = owner_of.get(row[0]) if ftp_users.is_managed(row) else None
+                uid_owners.setdefault(int(row[2]), set()).add(owner)
+        gid_names = {}
+        for row in group:
+            if row[2].isdigit():
+                gid_names.setdefault(int(row[2]), row[0])
+
+        kept_uids = {}
+        for user in users.values():
+            uid = old_uids.get(user.name)
+            if user.uid is None and uid is not None and uid not in used_uids:
+                kept_uids[user.name] = uid
+        used_uids.update(kept_uids.values())
+        for name, uid in kept_uids.items():
+            uid_owners.setdefault(uid, set()).add(users[name].owner)
+        kept_gids = dict((name, gid) for name, gid in old_gids.items()
+                         if name in kept_uids and gid not in gid_names)
+        reserved_gids = set(kept_gids.values())
+
+        next_uid = ftp_users.FIRST_UID
+        today = ftp_users.days_since_epoch()
+        folders = []
+
+        for user in users.values():
+            if user.name in system_names or user.name in group_names:
+                self.log('Skipping user %s: name is used by a system account or group' % user.name)
+                continue
+            if user.uid is not None and not ftp_users.FIRST_UID <= user.uid <= ftp_users.LAST_UID:
+                self.log('Skipping user %s: uid %d is outside %d-%d' % (
+                    user.name, user.uid, ftp_users.FIRST_UID, ftp_users.LAST_UID))
+                continue
+            if user.gid == 0:
+                self.log('Skipping user %s: gid 0 is the root group' % user.name)
+                continue
+
+            if user.uid is not None and uid_owners.get(user.uid, set()) - {user.owner}:
+                self.log('Skipping user %s: uid %d is used by a system account or another owner' % (
+                    user.name, user.uid))
+                continue
+
+            uid = user.uid if user.uid is not None else kept_uids.get(user.name)
+            if uid is None:
+                while next_uid in used_uids:
+                    next_uid += 1
+                if next_uid > ftp_users.LAST_UID:
+                    self.log('Skipping user %s: no free uid left' % user.name)
+                    continue
+                uid = next_uid
+            used_uids.add(uid)
+            uid_owners.setdefault(uid, set()).add(user.owner)
+
+            if user.gid is not None:
+                gid = user.gid
+            elif user.name in kept_gids:
+                gid = kept_gids[user.name]
+            else:
+                gid = uid
+                while gid in gid_names or gid in reserved_gids:
+                    gid += 1
+            if user.gid is None or gid not in gid_names:
+                # a group named after the user, like adduser and
+                # 'addgroup -g $GID $NAME' did in the old entrypoint
+                group.append([user.name, 'x', str(gid), ''])
+                gid_names[gid] = user.name
+                group_names.add(user.name)
+
+            if user.name in old_hashes:
+                password = old_hashes[user.name]
+            elif user.password:
+                password = ftp_users.password_hash(user.password)
+            else:
+                password = '!'
+            passwd.append([user.name, 'x', str(uid), str(gid), ftp_users.GECOS, user.folder, ftp_users.SHELL])
+            shadow.append([user.name, password, today, '0', '99999', '7', '', '', ''])
+            system_names.add(user.name)
+            folders.append((user.folder, uid, gid))
+            self.ids[user.name] = (uid, gid)
+
+        return passwd, shadow, group, folders
+
+    def write_tables(self, passwd, shadow, group):
+        ftp_users.write_atomic(self.path('/etc/passwd'), ftp_users.format_table(passwd), 0o644)
+        ftp_users.write_atomic(self.path('/etc/group'), ftp_users.format_table(group), 0o644)
+        ftp_users.write_atomic(self.path('/etc/shadow'), ftp_users.format_table(shadow), 0o640)
+
+    def make_folders(self, folders):
+        can_chown = os.geteuid() == 0
+        for folder, uid, gid in sorted(folders):
+            path = self.path(folder)
+            try:
+                os.makedirs(path, exist_ok=True)
+                if can_chown:
+                    os.chown(path, uid, gid)
+            except OSError as e:
+                self.log('Unable to create folder %s: %s' % (folder, e))
+
+    def user_config(self, user):
+        """vsftpd settings for the user_config_dir file of a user."""
+        config = ''.join('%s=%d\n' % (self.CONFIG_OPTIONS[key], value)
+                         for key, value in user.options if value and key in self.CONFIG_OPTIONS)
+        if user.name in self.read_only:
+            config += 'write_enable=NO\n'
+        return config
+
+    def user_config_path(self, name):
+        return os.path.join(self.path(self.USER_CONFIG_DIR), name)
+
+    def remove_user_config(self, name):
+        try:
+            os.unlink(self.user_config_path(name))
+        except FileNotFoundError:
+            pass
+
+    def write_user_configs(self, users, full=False):
+        """
+        Write the config files of users, users without settings have none.
+        With full, files of users that are not in users are removed too.
+        """
+        config_dir = self.path(self.USER_CONFIG_DIR)
+        os.makedirs(config_dir, exist_ok=True)
+        if full:
+            for name in os.listdir(config_dir):
+                if name not in users:
+                    self.remove_user_config(name)
+        for user in users.values():
+            config = self.user_config(user)
+            if config:
+                ftp_users.write_atomic(self.user_config_path(user.name), config, 0o644, fsync=False)
+            else:
+                self.remove_user_config(user.name)
+
+    def provision(self, users, remove=None, keep_hashes=(), all_users=None):
+        passwd, shadow, group = self.read_tables()
+        passwd, shadow, group, folders = self.build(users, passwd, shadow, group, remove, keep_hashes, all_users)
+        self.write_tables(passwd, shadow, group)
+        self.make_folders(folders)
+        self.write_user_configs(users, full=remove is None)
+        return len(folders)
+
+    def update(self, users, changed, removed, keep_hashes=()):
+        """
+        Apply a difference computed by ftp_sync: users is the new full set,
+        changed the added or modified users and removed the names that are
+        gone.
+        """
+        self.provision(changed, remove=list(removed) + list(changed), keep_hashes=keep_hashes, all_users=users)
+        for name in removed:
+            self.remove_user_config(name)
+
+
+class VirtualProvisioner(Provisioner):
+    """
+    Virtual users for vsftpd guest_enable: one pam_userdb database with all
+    users and a user_config_dir file per user.
+    """
+
+    USERDB = '/etc/vsftpd/virtual_users'
+    # users without an uid run as this account
+    DEFAULT_GUEST = 'ftp'
+    GUEST_PREFIX = 'ftpguest'
+
+    def __init__(self, root='/', log=print):
+        Provisioner.__init__(self, root, log)
+        self.hashes = {}
+        self.last_guests = None
+        self.guest_ids = {}
+
+    def guest_name(self, user):
+        if user.uid is None:
+            return self.DEFAULT_GUEST
+        return '%s%d' % (self.GUEST_PREFIX, user.uid)
+
+    def guests(self, users):
+        """One system account for every uid used by the FTP users."""
+        guests = {}
+        for user in users.values():
+            if user.uid is not None:
+                name = self.guest_name(user)
+                guests.setdefault(name, ftp_users.FtpUser(name, '', '/var/empty', user.uid, user.gid, ''))
+        return guests
+
+    def write_userdb(self, users, keep_hashes):
+        """Rebuild the pam_userdb database in one db_load run."""
+        hashes = {}
+        lines = []
+        for name, user in sorted(users.items()):
+            if name in keep_hashes and name in self.hashes:
+                hashed = self.hashes[name]
+            elif user.password:
+                hashed = ftp_users.password_hash(user.password)
+            else:
+                continue
+            hashes[name] = hashed
+            lines.append(name)
+            lines.append(hashed)
+
+        # pam_userdb adds the .db extension itself
+        path = self.path(self.USERDB) + '.db'
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        subprocess.run(['db_load', '-T', '-t', 'hash', tmp],
+                       input=''.join(line + '\n' for line in lines),
+                       universal_newlines=True, check=True)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+        self.hashes = hashes
+
+    def user_config(self, user):
+        return 'local_root=%s\nguest_username=%s\n%s' % (
+            user.folder, self.guest_name(user), Provisioner.user_config(self, user))
+
+    def write_user_config(self, user, guest_ids):
+        ftp_users.write_atomic(self.user_config_path(user.name), self.user_config(user), 0o644, fsync=False)
+        uid, gid = guest_ids.get(self.guest_name(user), (None, None))
+        if uid is None:
+            return None
+        return (user.folder, uid, gid)
+
+    def write_guests(self, users):
+        """Write the guest accounts if they changed, returns name -> (uid, gid)."""
+        guests = self.guests(users)
+        if guests == self.last_guests:
+            return self.guest_ids
+        passwd, shadow, group = self.read_tables()
+        passwd, shadow, group, _ = self.build(guests, passwd, shadow, group)
+        self.write_tables(passwd, shadow, group)
+        self.last_guests = guests
+        self.guest_ids = dict((row[0], (int(row[2]), int(row[3]))) for row in passwd
+                              if row[2].isdigit() and row[3].isdigit())
+        return self.guest_ids
+
+    def provision(self, users, remove=None, keep_hashes=()):
+        guest_ids = self.write_guests(users)
+        self.write_userdb(users, keep_hashes)
+
+        config_dir = self.path(self.USER_CONFIG_DIR)
+        os.makedirs(config_dir, exist_ok=True)
+        for name in os.listdir(config_dir):
+            if name not in users:
+                self.remove_user_config(name)
+        folders = [self.write_user_config(user, guest_ids) for user in users.values()]
+        self.make_folders([f for f in folders if f])
+        return len(users)
+
+    def update(self, users, changed, removed, keep_hashes=()):
+        keep_hashes = set(keep_hashes) | (set(users) - set(changed))
+        guest_ids = self.write_guests(users)
+        self.write_userdb(users, keep_hashes)
+        for name in removed:
+            self.remove_user_config(name)
+        folders = [self.write_user_config(user, guest_ids) for user in changed.values()]
+        self.make_folders([f for f in folders if f])
+
+
+PROVISIONERS = {
+    'local': Provisioner,
+    'virtual': VirtualProvisioner,
+}
+
+
+def provision(users_dir=ftp_users.USERS_DIR, root='/', log=print, mode='local'):
+    """Read all users.list files and (re)create every FTP account."""
+    def on_error(path, lineno, error):
+        log('Skipping user in %s: %s' % (path, error))
+
+    users = ftp_users.load_users(users_dir, on_error)
+    return PROVISIONERS[mode](root, log).provision(users)
+
+
+def migrate(users_dir=ftp_users.USERS_DIR, log=print):
+    """Replace plaintext passwords in all users.list files with hashes."""
+    total = 0
+    for path in ftp_users.find_users_lists(users_dir):
+        count = ftp_users.hash_users_list(path)
+        if count:
+            log('Hashed %d passwords in %s' % (count, path))
+        total += count
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create system accounts for all FTP users.')
+    parser.add_argument('--users-dir', default=ftp_users.USERS_DIR,
+                        help='directory with users.list files (default: %(default)s)')
+    parser.add_argument('--root', default='/',
+                        help='write /etc files and folders relative to this directory')
+    parser.add_argument('--mode', choices=sorted(PROVISIONERS), default='local',
+                        help='system accounts or vsftpd virtual users (default: %(default)s)')
+    parser.add_argument('--migrate', action='store_true',
+                        help='only replace plaintext passwords in users.list files with hashes')
+    args = parser.parse_args(argv)
+
+    if args.migrate:
+        migrate(args.users_dir)
+        return 0
+
+    start = time.monotonic()
+    count = provision(args.users_dir, args.root, mode=args.mode)
+    print('Created %d FTP users in %.2fs' % (count, time.monotonic() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
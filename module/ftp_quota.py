@@ -0,0 +1,301 @@
+"""
+ftp_quota.py
+
+Disk quotas for FTP accounts and OpenPanel users.
+
+quota is an account option and an owner.conf limit in bytes (see
+ftp_users.py). The account quota is the size of its folder, the owner quota
+the size of all folders of its accounts together.
+
+Inside the container this runs as a thread of ftp_xferlog.py:
+
+- the folders are walked every SCAN_INTERVAL seconds, a directory is only
+  listed again when its mtime changed or a transfer touched it, everything
+  else comes from the cache (see DiskUsage)
+- uploads are added to the usage right away, so an account is stopped
+  without waiting for the next walk
+- accounts over their quota or over the quota of their owner get
+  write_enable=NO through the quota operation of the control socket and
+  their sessions are ended, it only applies to new logins. Uploads that
+  are logged for an account that is still over stop its uploads again
+
+The figures are written to /etc/openpanel/ftp/users/<owner>/quota.json and
+the account index, module/ftp.py serves them without walking anything.
+"""
+import json
+import os
+import threading
+import time
+
+try:
+    from . import ftp_control, ftp_users
+except ImportError:
+    import ftp_control
+    import ftp_users
+
+
+QUOTA_FILE = 'quota.json'
+# seconds between walks of the folders
+SCAN_INTERVAL = 60
+# every this many walks the cache is dropped, for files changed in place
+# by something else than vsftpd
+FULL_SCAN_EVERY = 60
+
+
+def quota_path(owner, users_dir=ftp_users.USERS_DIR):
+    return os.path.join(users_dir, owner, QUOTA_FILE)
+
+
+def read_quota(owner, users_dir=ftp_users.USERS_DIR):
+    """Disk usage and quotas of an OpenPanel user and its FTP users from quota.json."""
+    try:
+        with open(quota_path(owner, users_dir), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'total': {'used': 0, 'quota': 0}, 'users': {}, 'updated': None}
+
+
+class DiskUsage:
+    """
+    Size of directory trees. Every directory keeps the total size of its
+    files and its subdirectories from the last listing, it is only listed
+    again when its mtime changed or it was marked dirty.
+    """
+
+    def __init__(self):
+        self.dirs = {}      # path -> (mtime_ns, bytes of its files, subdirectories)
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def mark(self, path):
+        """A file in the directory of path was written."""
+        with self.lock:
+            self.dirty.add(os.path.dirname(path))
+
+    def clear(self):
+        with self.lock:
+            self.dirs = {}
+
+    def list_dir(self, path, mtime):
+        size = 0
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+        return mtime, size, tuple(subdirs)
+
+    def size(self, top):
+        """Total size of the files under top, 0 if it doesn't exist."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        visited = set()
+        total = 0
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            visited.add(path)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                cached = self.dirs.get(path)
+                if cached is None or cached[0] != mtime or path in dirty:
+                    cached = self.dirs[path] = self.list_dir(path, mtime)
+            except OSError:
+                self.dirs.pop(path, None)
+                continue
+            total += cached[1]
+            stack.extend(cached[2])
+        with self.lock:
+            # dirty directories outside of top are kept for other folders
+            self.dirty |= dirty - visited
+        return total
+
+
+def top_folders(folders):
+    """Folders that are not inside another one, so nothing is counted twice."""
+    top = []
+    for folder in sorted(set(folders)):
+        if not top or not (folder + '/').startswith(top[-1].rstrip('/') + '/'):
+            top.append(folder)
+    return top
+
+
+class QuotaScanner:
+    """Keeps disk usage of all accounts and enforces their quotas."""
+
+    def __init__(self, users_dir=ftp_users.USERS_DIR, index=None,
+                 control_socket=ftp_control.SOCKET_PATH, log=print):
+        self.users_dir = users_dir
+        self.index = index          # ftp_index.AccountIndex with the accounts
+        self.control_socket = control_socket
+        self.log = log
+        self.disk = DiskUsage()
+        self.folders = {}           # folder -> bytes from the last walk
+        self.accounts = {}          # name -> account row of the index
+        self.added = {}             # name -> bytes uploaded since the last walk
+        self.owners = {}            # owner -> bytes of all its folders from the last walk
+        self.owner_accounts = {}    # owner -> names of its accounts
+        self.owner_quotas = {}
+        self.over = None            # names over quota, None until the first walk
+        self.uploaded = set()       # names that uploaded while over quota
+        self.written = {}           # owner -> last quota.json content
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.scans = 0
+
+    def add(self, event):
+        """Count an upload right away, called for every log event."""
+        if not event.ok or not event.path or event.action not in ('UPLOAD', 'DELETE'):
+            return
+        self.disk.mark(event.path)
+        if event.action != 'UPLOAD':
+            return
+        with self.lock:
+            account = self.accounts.get(event.user)
+            if account is None:
+                return
+            self.added[event.user] = self.added.get(event.user, 0) + event.bytes
+            over = self.is_over(account, self.folders.get(account['folder'], 0) + self.added[event.user],
+                                self.owner_used(account['owner']))
+            uploaded_over = event.user in (self.over or ())
+            if uploaded_over:
+                # a session that was logged in before still uploads
+                self.uploaded.add(event.user)
+        # over a quota now, or still uploading? don't wait for the next walk
+        if over or uploaded_over:
+            self.wakeup.set()
+
+    def is_over(self, account, used, owner_used):
+        quota = self.owner_quotas.get(account['owner'])
+        return bool((account['quota'] and used >= account['quota']) or (quota and owner_used >= quota))
+
+    def owner_used(self, owner):
+        # call with self.lock held
+        return self.owners.get(owner, 0) + sum(self.added.get(name, 0) for name in self.owner_accounts.get(owner, ()))
+
+    def usage(self):
+        """Returns (account usage, owner usage) from the last walk and the uploads since."""
+        with self.lock:
+            users = dict((name, self.folders.get(account['folder'], 0) + self.added.get(name, 0))
+                         for name, account in self.accounts.items())
+            owners = dict((owner, self.owner_used(owner)) for owner in self.owners)
+        return users, owners
+
+    def over_quota(self, usage):
+        users, owners = usage
+        with self.lock:
+            return set(name for name, account in self.accounts.items()
+                       if self.is_over(account, users.get(name, 0), owners.get(account['owner'], 0)))
+
+    def scan(self):
+        """Walk all folders, using the cache for unchanged directories."""
+        self.scans += 1
+        if self.scans % FULL_SCAN_EVERY == 0:
+            self.disk.clear()
+        accounts = dict((account['username'], account) for account in self.index.all_accounts())
+        folders = {}
+        for folder in top_folders(account['folder'] for account in accounts.values()):
+            folders[folder] = self.disk.size(folder)
+        # folders inside another one were walked with it
+        for account in accounts.values():
+            if account['folder'] not in folders:
+                folders[account['folder']] = self.disk.size(account['folder'])
+
+        owner_accounts = {}
+        for name, account in accounts.items():
+            owner_accounts.setdefault(account['owner'], []).append(name)
+        owners = {}
+        owner_quotas = {}
+        for owner, names in owner_accounts.items():
+            owners[owner] = sum(folders[folder] for folder in top_folders(accounts[name]['folder'] for name in names))
+            owner_quotas[owner] = self.owner_quota(owner)
+
+        with self.lock:
+            self.accounts = accounts
+            self.folders = folders
+            self.owners = owners
+            self.owner_accounts = owner_accounts
+            self.owner_quotas = owner_quotas
+            self.added = {}
+
+    def owner_quota(self, owner):
+        if not owner:
+            return 0
+        return ftp_users.read_owner_conf(os.path.join(self.users_dir, owner, ftp_users.OWNER_CONF)).get('quota', 0)
+
+    def write(self, usage, over):
+        users, owners = usage
+        self.index.write_disk_usage(users)
+        by_owner = {}
+        with self.lock:
+            for name, account in self.accounts.items():
+                by_owner.setdefault(account['owner'], {})[name] = {
+                    'used': users.get(name, 0), 'quota': account['quota'], 'over': name in over}
+        for owner, accounts in by_owner.items():
+            if not owner:
+                continue
+            data = {'total': {'used': owners.get(owner, 0), 'quota': self.owner_quotas.get(owner, 0)},
+                    'users': accounts}
+            if self.written.get(owner) == data:
+                continue
+            path = quota_path(owner, self.users_dir)
+            if not os.path.isdir(os.path.dirname(path)):
+                continue
+            ftp_users.write_atomic(path, json.dumps(dict(data, updated=int(time.time())), sort_keys=True),
+                                   0o644, fsync=False)
+            self.written[owner] = data
+
+    def enforce(self, over):
+        """
+        Tell the control socket which accounts are over quota when that
+        changed, and which of them uploaded since.
+        """
+        with self.lock:
+            stop = self.uploaded & over
+            self.uploaded = set()
+        if over == self.over and not stop:
+            return
+        try:
+            result = ftp_control.call([{'op': 'quota', 'over': sorted(over), 'stop': sorted(stop)}],
+                                      self.control_socket)[0]
+        except (OSError, ValueError, ftp_control.ControlError) as e:
+            self.log('Unable to enforce quotas: %s' % e)
+            return
+        if result.get('ok'):
+            self.over = over
+            for name in result.get('changed', ()):
+                self.log('FTP user %s is %s quota' % (name, 'over' if name in over else 'within'))
+
+    def run(self, stop):
+        """Walk, write and enforce until stop is set, stop is a threading.Event."""
+        while not stop.is_set():
+            try:
+                self.scan()
+                usage = self.usage()
+                over = self.over_quota(usage)
+                self.write(usage, over)
+                self.enforce(over)
+            except Exception as e:
+                # the thread must survive a broken folder or a locked index
+                self.log('Quota scan failed: %s' % e)
+            self.wakeup.wait(SCAN_INTERVAL)
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                # an upload went over a quota, enforce before walking again
+                usage = self.usage()
+                over = self.over_quota(usage)
+                self.enforce(over)
+
+
+def start(users_dir, index, control_socket=ftp_control.SOCKET_PATH, log=print):
+    """Run a QuotaScanner in a daemon thread, returns it and its stop event."""
+    scanner = QuotaScanner(users_dir, index, control_socket, log)
+    stop = threading.Event()
+    thread = threading.Thread(target=scanner.run, args=(stop,), name='quota', daemon=True)
+    thread.start()
+    return scanner, stop
@@ -0,0 +1,268 @@
+"""
+ftp_sessions.py
+
+FTP sessions from the vsftpd process titles in /proc. vsftpd.conf has
+setproctitle_enable=YES, so a session looks like:
+
+    vsftpd: 1.2.3.4: connected          before the login
+    vsftpd: 1.2.3.4/alice: IDLE
+    vsftpd: 1.2.3.4/alice: RETR backup.tar
+
+A logged in session can have a privileged and an unprivileged process
+with the same title prefix, they are counted once.
+
+SessionTracker keeps the sessions between polls for the session inspector
+of OpenAdmin, with the transfer rate of every session.
+"""
+import os
+import signal
+import threading
+import time
+from collections import namedtuple
+
+
+PREFIX = 'vsftpd: '
+# commands in the title of a session that is uploading
+UPLOAD_COMMANDS = ('STOR', 'APPE', 'STOU')
+
+# the inspector reads /proc at most this often, requests in between get
+# the last poll
+POLL_INTERVAL = 1.0
+# ended sessions that are remembered for incremental polls
+ENDED_KEEP = 1000
+
+Session = namedtuple('Session', 'pid ip user status')
+
+
+def read_stat(pid, proc='/proc'):
+    """Return (ppid, start time in clock ticks after boot) of a vsftpd process, or None."""
+    try:
+        with open('%s/%s/stat' % (proc, pid), 'rb') as f:
+            stat = f.read()
+        # the name in parentheses can contain spaces, fields follow the last ')'
+        if not stat[stat.index(b'(') + 1:stat.rindex(b')')].startswith(b'vsftpd'):
+            return None
+        fields = stat[stat.rindex(b')') + 2:].split()
+        return int(fields[1]), int(fields[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_title(pid, proc='/proc'):
+    """Process title, '' once the process is gone."""
+    try:
+        with open('%s/%s/cmdline' % (proc, pid), 'rb') as f:
+            return f.read().replace(b'\0', b' ').strip().decode('utf-8', 'replace')
+    except OSError:
+        return ''
+
+
+def read_io(pid, proc='/proc'):
+    """Bytes read plus written by a process, sockets and sendfile() included."""
+    try:
+        with open('%s/%s/io' % (proc, pid), 'rb') as f:
+            counters = dict(line.split(b':', 1) for line in f.read().splitlines())
+        # a transfer reads and writes every byte once, count it once
+        return max(int(counters[b'rchar']), int(counters[b'wchar']))
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+def read_process(pid, proc='/proc'):
+    """Return (ppid, title) of a vsftpd process, or None."""
+    stat = read_stat(pid, proc)
+    if stat is None:
+        return None
+    title = read_title(pid, proc)
+    if not title:
+        return None
+    return stat[0], title
+
+
+def parse_title(title):
+    """Return (ip, user, status) from a process title, user is '' before the login."""
+    if not title.startswith(PREFIX):
+        return None
+    head, _, status = title[len(PREFIX):].partition(': ')
+    if not status:
+        # the listener and helper processes
+        return None
+    ip, _, user = head.partition('/')
+    return ip, user, status
+
+
+def read_sessions(proc='/proc'):
+    """List a Session for every connection, newest pid last."""
+    processes = {}
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        process = read_process(pid, proc)
+        if process is None:
+            continue
+        parsed = parse_title(process[1])
+        if parsed is not None:
+            processes[int(pid)] = (process[0],) + parsed
+    sessions, _ = group_sessions(processes)
+    return [sessions[pid] for pid in sorted(sessions)]
+
+
+def group_sessions(processes):
+    """
+    processes maps pid -> (ppid, ip, user, status). Returns a Session per
+    pid of the first process of a session and the session pid of every pid.
+    """
+    sessions = {}
+    root_of = {}
+    for pid in sorted(processes):
+        ppid, ip, user, status = processes[pid]
+        parent = processes.get(ppid)
+        if parent is not None and parent[1:3] == (ip, user) and ppid in root_of:
+            # the unprivileged child knows what the session is doing
+            root = root_of[pid] = root_of[ppid]
+            sessions[root] = sessions[root]._replace(status=status)
+        else:
+            root_of[pid] = pid
+            sessions[pid] = Session(pid, ip, user, status)
+    return sessions, root_of
+
+
+def count_sessions(sessions):
+    """Logged in sessions per FTP user."""
+    counts = {}
+    for session in sessions:
+        if session.user:
+            counts[session.user] = counts.get(session.user, 0) + 1
+    return counts
+
+
+def end_sessions(names=(), uploading=(), proc='/proc'):
+    """
+    End every session of the FTP users in names and the sessions of the
+    users in uploading that are uploading, returns how many were ended.
+    """
+    stopped = 0
+    for session in read_sessions(proc):
+        if session.user in names or (session.user in uploading and
+                                     session.status.split(' ', 1)[0].upper() in UPLOAD_COMMANDS):
+            try:
+                os.kill(session.pid, signal.SIGTERM)
+                stopped += 1
+            except OSError:
+                continue
+    return stopped
+
+
+class SessionTracker:
+    """
+    Sessions with their command and transfer rate, kept between polls.
+
+    A poll lists /proc but only parses the stat of processes it didn't see
+    before, known vsftpd processes only have their title and io counters
+    read. Every change gets a version, so a client that passes the version
+    of its last poll only gets the sessions that changed and the ones that
+    ended since.
+    """
+
+    def __init__(self, proc='/proc'):
+        self.proc = proc
+        self.lock = threading.Lock()
+        self.version = 0
+        self.polled = None
+        self.known = {}         # pid -> (ppid, start) of vsftpd processes
+        self.ignored = set()    # pids of other processes
+        self.io = {}            # session pid -> bytes of its processes at the last poll
+        self.sessions = {}      # session pid -> dict for the inspector
+        self.ended = []         # (version, pid, user) of ended sessions, oldest first
+        self.boot_time = self.read_boot_time()
+        self.ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def read_boot_time(self):
+        try:
+            with open(os.path.join(self.proc, 'stat'), 'rb') as f:
+                for line in f:
+                    if line.startswith(b'btime '):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def poll(self):
+        now = time.monotonic()
+        elapsed = now - self.polled if self.polled is not None else None
+        self.polled = now
+
+        pids = set(int(pid) for pid in os.listdir(self.proc) if pid.isdigit())
+        # a pid that was reused between two polls keeps its old kind
+        self.ignored &= pids
+        for pid in list(self.known):
+            if pid not in pids:
+                del self.known[pid]
+        for pid in pids - self.ignored - set(self.known):
+            stat = read_stat(pid, self.proc)
+            if stat is None:
+                self.ignored.add(pid)
+            else:
+                self.known[pid] = stat
+
+        processes = {}
+        for pid, (ppid, _) in self.known.items():
+            parsed = parse_title(read_title(pid, self.proc))
+            if parsed is not None:
+                processes[pid] = (ppid,) + parsed
+        sessions, root_of = group_sessions(processes)
+
+        io = dict.fromkeys(sessions, 0)
+        for pid, root in root_of.items():
+            io[root] += read_io(pid, self.proc)
+
+        version = self.version + 1
+        changed = False
+        for pid, session in sessions.items():
+            rate = 0
+            if elapsed and pid in self.io:
+                rate = int(max(0, io[pid] - self.io[pid]) / elapsed)
+            info = {
+                'pid': pid,
+                'ip': session.ip,
+                'user': session.user,
+                'status': session.status,
+                'command': session.status.split(' ', 1)[0].upper() if session.user else '',
+                'rate': rate,
+                'started': self.boot_time + self.known[pid][1] // self.ticks,
+            }
+            old = self.sessions.get(pid)
+            if old is None or any(old[key] != info[key] for key in ('user', 'status', 'rate')):
+                info['version'] = version
+                self.sessions[pid] = info
+                changed = True
+        for pid in list(self.sessions):
+            if pid not in sessions:
+                self.ended.append((version, pid, self.sessions.pop(pid)['user']))
+                changed = True
+        del self.ended[:-ENDED_KEEP]
+        self.io = io
+        if changed:
+            self.version = version
+
+    def snapshot(self, since=None, users=None):
+        """
+        Returns {"version", "sessions", "ended", "full"}. With since, only
+        sessions changed after that version and the pids of sessions ended
+        after it, unless it is too old. users limits the result to sessions
+        of these FTP users.
+        """
+        with self.lock:
+            if self.polled is None or time.monotonic() - self.polled >= POLL_INTERVAL:
+                self.poll()
+            full = since is None or since > self.version or (
+                len(self.ended) == ENDED_KEEP and since < self.ended[0][0])
+            sessions = [dict(info) for info in self.sessions.values()
+                        if full or info['version'] > since]
+            ended = [] if full else [pid for version, pid, user in self.ended
+                                     if version > since and (users is None or user in users)]
+            version = self.version
+        if users is not None:
+            sessions = [info for info in sessions if info['user'] in users]
+        sessions.sort(key=lambda info: info['pid'])
+        return {'version': version, 'sessions': sessions, 'ended': ended, 'full': full}
@@ -0,0 +1,326 @@
+"""
+ftp_sync.py
+
+Keeps the FTP accounts in sync with the users.list files while vsftpd is
+running.
+
+On start every account is created once (same as ftp_provision.py), then
+/etc/openpanel/ftp/users/**/users.list is watched with inotify. Only the
+files that changed are parsed again and only the added, removed or changed
+users are applied: passwords are hashed and folders created just for those,
+so `opencli ftp-add` takes effect without a container restart.
+
+Used by start_vsftpd.sh inside the docker image:
+
+    python3 ftp_sync.py [--daemon] [--mode local|virtual] [--users-dir DIR] [--root DIR]
+                        [--control-socket PATH]
+
+SIGHUP forces a full resync. With --control-socket the accounts can also
+be changed through ftp_control.py.
+"""
+import argparse
+import ctypes
+import errno
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+
+import ftp_control
+import ftp_index
+import ftp_provision
+import ftp_users
+
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+EVENT = struct.Struct('iIII')
+
+# wait for more events before applying, 'echo >>' and a rename of a
+# temporary file both produce several events
+SETTLE_DELAY = 0.2
+POLL_INTERVAL = 5
+
+
+class Inotify:
+    """Minimal inotify wrapper on top of libc, watches directories only."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, 'inotify_add_watch failed', path)
+        self.watches[wd] = path
+
+    def add_tree(self, path):
+        """Watch a directory and all directories below it."""
+        for dirpath, dirnames, filenames in os.walk(path):
+            self.add_watch(dirpath)
+
+    def read(self, timeout=None):
+        """Yield (directory, name, mask) for pending events."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            yield self.watches.get(wd), name, mask
+
+    def close(self):
+        os.close(self.fd)
+
+
+class UserSync:
+    """
+    Remembers the parsed content of every users.list and the accounts that
+    were applied, so a change only costs the lines that changed.
+    """
+
+    def __init__(self, users_dir=ftp_users.USERS_DIR, root='/', log=print, mode='local', index=None):
+        self.users_dir = users_dir
+        self.provisioner = ftp_provision.PROVISIONERS[mode](root, log)
+        self.log = log
+        self.index = index    # ftp_index.AccountIndex kept up to date, optional
+        self.lists = {}   # path -> (stat_key(), [FtpUser])
+        self.users = {}   # name -> FtpUser that is currently applied
+        # held while accounts are changed, the control socket and the
+        # watcher run in different threads
+        self.lock = threading.RLock()
+
+    def on_error(self, path, lineno, error):
+        self.log('Skipping user in %s: %s' % (path, error))
+
+    def update_index(self, write):
+        # the accounts work without the index, only log when it fails
+        if self.index is None:
+            return
+        try:
+            write(self.index)
+        except ftp_index.ERRORS as e:
+            self.log('Unable to update the account index: %s' % e)
+
+    def stat_key(self, path):
+        # owner.conf limits are applied to the accounts of its users.list
+        version = ftp_users.list_version(path)
+        if version is None:
+            return None
+        return version, ftp_users.list_version(os.path.join(os.path.dirname(path), ftp_users.OWNER_CONF))
+
+    def read_list(self, path):
+        key = self.stat_key(path)
+        if key is None:
+            self.lists.pop(path, None)
+            return
+        cached = self.lists.get(path)
+        if cached and cached[0] == key:
+            return
+        try:
+            users = list(ftp_users.parse_users_list(path, self.users_dir, self.on_error))
+        except FileNotFoundError:
+            self.lists.pop(path, None)
+            return
+        self.lists[path] = (key, users)
+
+    def desired(self):
+        # same order as find_users_lists(), so duplicates resolve the same way
+        paths = sorted(self.lists, key=lambda p: (os.path.dirname(p) != self.users_dir, p))
+        return ftp_users.merge_users([(p, self.lists[p][1]) for p in paths], self.on_error)
+
+    def full_sync(self):
+        """Parse every users.list and recreate every account."""
+        with self.lock:
+            self.lists = {}
+            for path in ftp_users.find_users_lists(self.users_dir):
+                self.read_list(path)
+            users = self.desired()
+            self.provisioner.provision(users)
+            self.users = users
+            self.update_index(lambda index: index.replace_all(users, self.provisioner.ids))
+            return len(users)
+
+    def sync(self, paths):
+        """Parse the given users.list files again and apply the difference."""
+        with self.lock:
+            return self._sync(paths)
+
+    def _sync(self, paths):
+        for path in paths:
+            self.read_list(path)
+        desired = self.desired()
+
+        removed = [name for name in self.users if name not in desired]
+        changed = {}
+        keep_hashes = set()
+        for name, user in desired.items():
+            old = self.users.get(name)
+            if old == user:
+                continue
+            changed[name] = user
+            if old is not None and old.password == user.password:
+                keep_hashes.add(name)
+
+        if not removed and not changed:
+            return 0
+
+        self.provisioner.update(desired, changed, removed, keep_hashes)
+        self.users = desired
+        self.update_index(lambda index: index.update(changed, removed, self.provisioner.ids))
+        self.log('FTP users synced: %d added or changed, %d removed' % (len(changed), len(removed)))
+        return len(changed) + len(removed)
+
+
+def watch(sync, stop):
+    """Apply users.list changes until stop() returns True."""
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError) as e:
+        sync.log('inotify is not available (%s), polling every %ds' % (e, POLL_INTERVAL))
+        return poll(sync, stop)
+
+    inotify.add_tree(sync.users_dir)
+    # files created before the watches were added
+    sync.sync(ftp_users.find_users_lists(sync.users_dir))
+
+    try:
+        while not stop():
+            dirty = set()
+            rescan = False
+            timeout = 1.0
+            while True:
+                events = list(inotify.read(timeout))
+                if not events:
+                    break
+                for directory, name, mask in events:
+                    if mask & IN_Q_OVERFLOW or directory is None:
+                        rescan = True
+                    elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        # a new OpenPanel user, watch it and pick up its list
+                        inotify.add_tree(os.path.join(directory, name))
+                        dirty.update(ftp_users.find_users_lists(os.path.join(directory, name)))
+                    elif mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                        prefix = os.path.join(directory, name) + os.sep
+                        dirty.update(p for p in sync.lists if p.startswith(prefix))
+                    elif name in (ftp_users.LIST_NAME, ftp_users.OWNER_CONF):
+                        dirty.add(os.path.join(directory, ftp_users.LIST_NAME))
+                timeout = SETTLE_DELAY
+            if rescan:
+                dirty.update(sync.lists)
+                dirty.update(ftp_users.find_users_lists(sync.users_dir))
+            if dirty:
+                sync.sync(dirty)
+    finally:
+        inotify.close()
+
+
+def poll(sync, stop):
+    """Fallback for kernels without inotify: compare stat() of every list."""
+    while not stop():
+        time.sleep(POLL_INTERVAL)
+        paths = set(ftp_users.find_users_lists(sync.users_dir)) | set(sync.lists)
+        changed = [p for p in paths if sync.stat_key(p) != (sync.lists.get(p) or (None,))[0]]
+        if changed:
+            sync.sync(changed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Keep FTP accounts in sync with users.list files.')
+    parser.add_argument('--users-dir', default=ftp_users.USERS_DIR,
+                        help='directory with users.list files (default: %(default)s)')
+    parser.add_argument('--root', default='/',
+                        help='write /etc files and folders relative to this directory')
+    parser.add_argument('--mode', choices=sorted(ftp_provision.PROVISIONERS), default='local',
+                        help='system accounts or vsftpd virtual users (default: %(default)s)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='go to background once all users are created')
+    parser.add_argument('--no-index', action='store_true',
+                        help='don\'t maintain %s in the users directory (see ftp_index.py)' % ftp_index.INDEX_NAME)
+    parser.add_argument('--control-socket',
+                        help='accept account changes on this unix socket (see ftp_control.py)')
+    args = parser.parse_args(argv)
+
+    def log(msg):
+        print(msg, flush=True)
+
+    def open_index():
+        if args.no_index:
+            return None
+        try:
+            return ftp_index.AccountIndex(ftp_index.index_path(users_dir))
+        except ftp_index.ERRORS as e:
+            log('Unable to open the account index: %s' % e)
+            return None
+
+    users_dir = os.path.abspath(args.users_dir)
+    os.makedirs(users_dir, exist_ok=True)
+    sync = UserSync(users_dir, args.root, log, args.mode, open_index())
+    start = time.monotonic()
+    count = sync.full_sync()
+    log('Created %d FTP users in %.2fs' % (count, time.monotonic() - start))
+
+    # return to start_vsftpd.sh only after the accounts exist
+    if args.daemon:
+        # the SQLite connection must not cross the fork: the parent closing
+        # its copy would checkpoint and delete the WAL the child writes to
+        if sync.index is not None:
+            sync.index.close()
+        if os.fork():
+            return 0
+        sync.index = open_index()
+
+    if args.control_socket:
+        ftp_control.serve(sync, args.control_socket)
+
+    stopping = []
+    resync = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGHUP, lambda signum, frame: resync.append(signum))
+
+    def stop():
+        if resync:
+            del resync[:]
+            sync.full_sync()
+        return bool(stopping)
+
+    watch(sync, stop)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,610 @@
+"""
+ftp_users.py
+
+Shared helpers for the OpenPanel FTP users.list files.
+
+Every OpenPanel user has a /etc/openpanel/ftp/users/<owner>/users.list file
+and every line in it describes one FTP sub-user:
+
+    name|password[|folder][|uid][|gid][|options]
+
+options are comma separated key=value pairs, see ACCOUNT_OPTIONS. The
+password is a crypt(3) hash (see hash_password), plaintext passwords
+from older lists are still accepted and hashed when the account is created.
+
+A users.list directly in /etc/openpanel/ftp/users/ is used by the
+standalone image and has no owner.
+
+Limits for all accounts of an OpenPanel user are in owner.conf next to its
+users.list, one key=value per line, see OWNER_LIMITS.
+
+This file only uses the standard library: it is imported by the OpenPanel
+and OpenAdmin modules and copied into the docker image for the provisioner.
+"""
+import fcntl
+import hashlib
+import math
+import os
+import re
+import time
+import warnings
+from collections import namedtuple
+from contextlib import contextmanager
+
+# crypt is imported by the first hash, see get_crypt()
+_crypt = None
+_crypt_loaded = False
+
+
+USERS_DIR = '/etc/openpanel/ftp/users'
+LIST_NAME = 'users.list'
+
+# accounts created by us are marked with this gecos so they can be told
+# apart from the system accounts that ship with the image
+GECOS = 'openpanel-ftp'
+SHELL = '/sbin/nologin'
+FIRST_UID = 1000
+LAST_UID = 60000
+
+USERNAME_RE = re.compile(r'^[a-z_][a-z0-9_.-]{0,31}$')
+
+# accounts and groups of the alpine image and of its packages, an FTP user
+# with one of these names would be skipped by the provisioner
+RESERVED_NAMES = frozenset((
+    'root', 'bin', 'daemon', 'sys', 'adm', 'tty', 'disk', 'lp', 'kmem', 'wheel', 'floppy',
+    'sync', 'shutdown', 'halt', 'mail', 'news', 'uucp', 'operator', 'man', 'postmaster',
+    'cron', 'ftp', 'sshd', 'at', 'squid', 'xfs', 'games', 'cyrus', 'vpopmail', 'ntp',
+    'smmsp', 'guest', 'nobody', 'nogroup', 'users', 'audio', 'cdrom', 'dialout', 'input',
+    'tape', 'video', 'netdev', 'kvm', 'shadow', 'utmp', 'ping', 'www-data', 'abuild', 'vsftp',
+))
+# the provisioner names the guest accounts of virtual users ftpguest<uid>
+RESERVED_PREFIXES = ('ftpguest',)
+
+
+# options is a sorted tuple of (key, value) pairs so users can be compared
+FtpUser = namedtuple('FtpUser', 'name password folder uid gid owner options', defaults=((),))
+
+# per account options, all are integers and 0 is unlimited:
+# max_rate      bytes per second for each session of the account
+# max_sessions  concurrent sessions of the account
+# quota         bytes in the folder of the account (see ftp_quota.py)
+ACCOUNT_OPTIONS = ('max_rate', 'max_sessions', 'quota')
+
+OWNER_CONF = 'owner.conf'
+# owner.conf keys, every account of the owner gets at most this value and
+# max_sessions and quota are also limits for all accounts together
+OWNER_LIMITS = ('max_rate', 'max_sessions', 'quota')
+
+
+class InvalidUser(ValueError):
+    pass
+
+
+# Function to find all users.list files
+def find_users_lists(users_dir=USERS_DIR):
+    found = []
+    for dirpath, dirnames, filenames in os.walk(users_dir):
+        dirnames.sort()
+        if LIST_NAME in filenames:
+            found.append(os.path.join(dirpath, LIST_NAME))
+    return found
+
+
+def owner_for_list(path, users_dir=USERS_DIR):
+    """Return the OpenPanel username that a users.list belongs to, or ''."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    if base_dir == os.path.abspath(users_dir):
+        return ''
+    return os.path.basename(base_dir)
+
+
+def check_username(name):
+    """Raise InvalidUser for names that are invalid or taken by the system."""
+    if not USERNAME_RE.match(name):
+        raise InvalidUser('invalid username %s' % name)
+    if name in RESERVED_NAMES or name.startswith(RESERVED_PREFIXES):
+        raise InvalidUser('username %s is reserved' % name)
+
+
+def _parse_id(value, field, name):
+    if value == '':
+        return None
+    if not value.isdigit():
+        raise InvalidUser('%s %s for user %s is not a number' % (field, value, name))
+    return int(value)
+
+
+def parse_line(line, owner=''):
+    """Parse one users.list line, returns None for empty lines."""
+    line = line.rstrip('\r\n')
+    if not line.strip():
+        return None
+
+    fields = line.split('|')
+    fields += [''] * (6 - len(fields))
+    name, password, folder, uid, gid, options = fields[:6]
+
+    if not name:
+        return None
+    if not USERNAME_RE.match(name):
+        raise InvalidUser('invalid username %s' % name)
+
+    uid = _parse_id(uid, 'uid', name)
+    gid = _parse_id(gid, 'gid', name)
+    if uid is not None and gid is None:
+        gid = uid
+
+    if not folder:
+        folder = '/ftp/' + name
+    folder = check_folder(name, folder, owner)
+
+    return FtpUser(name, password, folder, uid, gid, owner, parse_options(options, name))
+
+
+def parse_options(value, name=''):
+    """Parse key=value,key=value into a sorted tuple of pairs."""
+    options = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, number = item.partition('=')
+        key = key.strip()
+        if key not in ACCOUNT_OPTIONS:
+            raise InvalidUser('unknown option %s for user %s' % (key, name))
+        options[key] = _parse_id(number.strip(), key, name) or 0
+    return tuple(sorted(options.items()))
+
+
+def format_options(options):
+    """dict or pairs of options to the users.list field, zero values are dropped."""
+    items = options.items() if isinstance(options, dict) else options
+    return ','.join('%s=%d' % (key, value) for key, value in sorted(items) if value)
+
+
+def read_owner_conf(path):
+    """Limits from an owner.conf as a dict, unknown keys are ignored."""
+    limits = {}
+    for line in read_lines(path):
+        key, sep, value = line.partition('=')
+        key, value = key.strip(), value.strip()
+        if sep and key in OWNER_LIMITS and value.isdigit():
+            limits[key] = int(value)
+    return limits
+
+
+def owner_conf_path(owner, users_dir=USERS_DIR):
+    return os.path.join(os.path.dirname(list_path(owner, users_dir)), OWNER_CONF)
+
+
+def apply_owner_limits(user, limits):
+    """Return user with every option capped by the limits of its owner."""
+    if not limits:
+        return user
+    options = dict(user.options)
+    for key, limit in limits.items():
+        if limit and (not options.get(key) or options[key] > limit):
+            options[key] = limit
+    return user._replace(options=tuple(sorted(options.items())))
+
+
+def check_folder(name, folder, owner=''):
+    """
+    Ensure the folder is absolute and, for OpenPanel users, inside the
+    home directory of the owner. Returns the normalized folder.
+    """
+    if not folder.startswith('/'):
+        raise InvalidUser('folder %s for user %s is not an absolute path' % (folder, name))
+    normalized = os.path.normpath(folder)
+    if owner:
+        home = '/home/' + owner
+        if normalized != home and not normalized.startswith(home + '/'):
+            raise InvalidUser('folder %s for user %s is not inside %s' % (folder, name, home))
+    return normalized
+
+
+def parse_users_list(path, users_dir=USERS_DIR, on_error=None):
+    """
+    Yield FtpUser for every valid line of a users.list file. Invalid lines
+    are passed to on_error(path, lineno, error) and skipped.
+    """
+    owner = owner_for_list(path, users_dir)
+    limits = read_owner_conf(os.path.join(os.path.dirname(path), OWNER_CONF)) if owner else {}
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                user = parse_line(line, owner)
+            except InvalidUser as e:
+                if on_error:
+                    on_error(path, lineno, e)
+                continue
+            if user:
+                yield apply_owner_limits(user, limits)
+
+
+def load_users(users_dir=USERS_DIR, on_error=None):
+    """
+    Read all users.list files once. Returns a dict name -> FtpUser, a name
+    used more than once is only kept the first time it is seen.
+    """
+    lists = [(path, parse_users_list(path, users_dir, on_error))
+             for path in find_users_lists(users_dir)]
+    return merge_users(lists, on_error)
+
+
+def merge_users(lists, on_error=None):
+    """Merge (path, users) pairs in order into a dict name -> FtpUser."""
+    users = {}
+    for path, parsed in lists:
+        for user in parsed:
+            if user.name in users:
+                if on_error:
+                    on_error(path, None, InvalidUser('user %s is already defined by %s' % (
+                        user.name, users[user.name].owner or 'the standalone list')))
+                continue
+            users[user.name] = user
+    return users
+
+
+def list_path(owner, users_dir=USERS_DIR):
+    """Path of the users.list of an OpenPanel user."""
+    if owner and not USERNAME_RE.match(owner):
+        raise InvalidUser('invalid owner %s' % owner)
+    return os.path.join(users_dir, owner, LIST_NAME)
+
+
+def format_line(name, password, folder='', uid=None, gid=None, options=None):
+    """A users.list line, raises InvalidUser when a field would add fields or lines."""
+    fields = [name, password, folder or '',
+              '' if uid is None else str(uid), '' if gid is None else str(gid),
+              format_options(options or {})]
+    for field in fields:
+        if '|' in field or '\n' in field or '\r' in field:
+            raise InvalidUser('fields of user %s can not contain | or a line break' % name)
+    while len(fields) > 2 and fields[-1] == '':
+        fields.pop()
+    return '|'.join(fields)
+
+
+def read_lines(path):
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+# Writers take an flock on users.list.lock for the whole read, change and
+# write, scripts can share it with: flock users.list.lock sh -c '...'
+# users.list.gen is a counter that is bumped on every write.
+LOCK_SUFFIX = '.lock'
+GENERATION_SUFFIX = '.gen'
+
+
+@contextmanager
+def locked(path):
+    """Hold the exclusive write lock of a users.list."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+def read_generation(path):
+    try:
+        with open(path + GENERATION_SUFFIX) as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def list_version(path):
+    """
+    Changes whenever a users.list is written, None if it doesn't exist.
+    The stat() part catches writers that don't bump the generation.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (read_generation(path), st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def write_lines(path, lines):
+    """
+    Replace a users.list with lines in one atomic rename and bump its
+    generation, call it with locked(path) held.
+    """
+    write_atomic(path, ''.join(line + '\n' for line in lines), 0o600)
+    write_atomic(path + GENERATION_SUFFIX, '%d\n' % (read_generation(path) + 1), 0o600, fsync=False)
+
+
+##### password hashing
+
+_ITOA64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+_SHA512_ORDER = (
+    (0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45), (25, 46, 4),
+    (47, 5, 26), (6, 27, 48), (28, 49, 7), (50, 8, 29), (9, 30, 51),
+    (31, 52, 10), (53, 11, 32), (12, 33, 54), (34, 55, 13), (56, 14, 35),
+    (15, 36, 57), (37, 58, 16), (59, 17, 38), (18, 39, 60), (40, 61, 19),
+    (62, 20, 41),
+)
+
+
+def _b64_from_24bit(b2, b1, b0, n):
+    w = (b2 << 16) | (b1 << 8) | b0
+    out = []
+    for _ in range(n):
+        out.append(_ITOA64[w & 0x3f])
+        w >>= 6
+    return ''.join(out)
+
+
+def _repeat(digest, length):
+    return (digest * (length // len(digest) + 1))[:length]
+
+
+def _sha512_crypt(password, salt, rounds=5000):
+    """Pure python SHA-512 crypt, used when the crypt module is missing."""
+    p = password.encode('utf-8')
+    s = salt.encode('utf-8')[:16]
+
+    b = hashlib.sha512(p + s + p).digest()
+    a = hashlib.sha512(p + s)
+    a.update(_repeat(b, len(p)))
+    i = len(p)
+    while i:
+        a.update(b if i & 1 else p)
+        i >>= 1
+    a = a.digest()
+
+    p_bytes = _repeat(hashlib.sha512(p * len(p)).digest(), len(p))
+    s_bytes = _repeat(hashlib.sha512(s * (16 + a[0])).digest(), len(s))
+
+    c = a
+    for r in range(rounds):
+        h = hashlib.sha512(p_bytes if r & 1 else c)
+        if r % 3:
+            h.update(s_bytes)
+        if r % 7:
+            h.update(p_bytes)
+        h.update(c if r & 1 else p_bytes)
+        c = h.digest()
+
+    encoded = ''.join(_b64_from_24bit(c[x], c[y], c[z], 4) for x, y, z in _SHA512_ORDER)
+    encoded += _b64_from_24bit(0, 0, c[63], 2)
+
+    prefix = '$6$' if rounds == 5000 else '$6$rounds=%d$' % rounds
+    return prefix + s.decode('utf-8') + '$' + encoded
+
+
+def make_salt(length=16):
+    return ''.join(_ITOA64[b & 0x3f] for b in os.urandom(length))
+
+
+def get_crypt():
+    """The crypt module, or None. Only imported when a password is hashed."""
+    global _crypt, _crypt_loaded
+    if not _crypt_loaded:
+        try:
+            # C implementation is much faster than the fallback below, but
+            # the module is deprecated and removed in python 3.13
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                import crypt as _crypt
+        except ImportError:
+            _crypt = None
+        _crypt_loaded = True
+    return _crypt
+
+
+def hash_password(password, salt=None):
+    """Return a SHA-512 crypt(3) hash, as used in /etc/shadow."""
+    if salt is None:
+        salt = make_salt()
+    crypt = get_crypt()
+    if crypt is not None:
+        return crypt.crypt(password, '$6$' + salt)
+    return _sha512_crypt(password, salt)
+
+
+# musl crypt() has no yescrypt, so only these can be used for shadow
+HASH_PREFIXES = ('$6$', '$5$', '$2a$', '$2b$', '$2y$')
+
+
+def is_hashed(password):
+    return password.startswith(HASH_PREFIXES) and password.count('$') >= 3
+
+
+def password_hash(password):
+    """Hash for a users.list password, hashes already in the list are kept."""
+    if is_hashed(password):
+        return password
+    return hash_password(password)
+
+
+# generated passwords: no | (the users.list separator), no quotes or
+# backslashes for shells and no characters that look alike (l 1 I O 0)
+PASSWORD_LOWER = 'abcdefghijkmnopqrstuvwxyz'
+PASSWORD_UPPER = 'ABCDEFGHJKLMNPQRSTUVWXYZ'
+PASSWORD_DIGITS = '23456789'
+PASSWORD_SYMBOLS = '!#%+-.:=?@_~'
+PASSWORD_CLASSES = (PASSWORD_LOWER, PASSWORD_UPPER, PASSWORD_DIGITS, PASSWORD_SYMBOLS)
+PASSWORD_ALPHABET = ''.join(PASSWORD_CLASSES)
+PASSWORD_LENGTH = 16
+
+# passwords that are refused by every strength meter
+COMMON_PASSWORDS = frozenset((
+    '123456', '123456789', '12345678', '1234567890', 'password', 'password1', 'qwerty',
+    'qwerty123', 'abc123', '111111', '123123', 'letmein', 'welcome', 'admin', 'admin123',
+    'iloveyou', 'monkey', 'dragon', 'secret', 'changeme', 'passw0rd', 'ftp', 'test',
+))
+
+
+def generate_passwords(count, length=PASSWORD_LENGTH):
+    """
+    count random passwords from secrets, each with a lower and upper case
+    letter, a digit and a symbol. The random bytes of a batch are read at
+    once, so thousands of passwords for an import cost one call.
+    """
+    import secrets
+    if length < len(PASSWORD_CLASSES):
+        raise ValueError('passwords need at least %d characters' % len(PASSWORD_CLASSES))
+    size = len(PASSWORD_ALPHABET)
+    # bytes above the last multiple of the alphabet size are skipped, so
+    # every character is equally likely
+    limit = 256 - 256 % size
+    passwords = []
+    pool = b''
+    chars = []
+    while len(passwords) < count:
+        if not pool:
+            pool = secrets.token_bytes(max(64, (count - len(passwords)) * length * 2))
+        for i, byte in enumerate(pool):
+            if byte >= limit:
+                continue
+            chars.append(PASSWORD_ALPHABET[byte % size])
+            if len(chars) < length:
+                continue
+            password = ''.join(chars)
+            chars = []
+            if all(any(c in password for c in chars_of) for chars_of in PASSWORD_CLASSES):
+                passwords.append(password)
+                if len(passwords) == count:
+                    break
+        else:
+            pool = b''
+            continue
+        pool = pool[i + 1:]
+    return passwords
+
+
+def password_strength(password, username=''):
+    """
+    Score a password from 0 (very weak) to 4 (strong), with the estimated
+    entropy in bits and the reasons it was lowered.
+    """
+    reasons = []
+    pool = 0
+    for chars_of, size in ((str.islower, 26), (str.isupper, 26), (str.isdigit, 10)):
+        if any(chars_of(c) for c in password):
+            pool += size
+    if any(not c.isalnum() for c in password):
+        pool += 33
+    # repeated characters and runs like abc or 321 add almost nothing
+    effective = 0
+    for i, c in enumerate(password):
+        if i and c == password[i - 1]:
+            continue
+        if i > 1 and ord(c) - ord(password[i - 1]) == ord(password[i - 1]) - ord(password[i - 2]) \
+                and abs(ord(c) - ord(password[i - 1])) == 1:
+            continue
+        effective += 1
+    if effective < len(password) * 3 / 4:
+        reasons.append('repeated characters or sequences')
+    bits = effective * math.log2(pool) if pool else 0.0
+
+    lower = password.lower()
+    if lower in COMMON_PASSWORDS or lower.rstrip('0123456789!') in COMMON_PASSWORDS:
+        reasons.append('common password')
+        bits = min(bits, 10.0)
+    if username and len(username) > 2 and username.lower() in lower:
+        reasons.append('contains the username')
+        # the username is the first thing that is tried
+        bits -= (len(username) - 1) * math.log2(pool)
+    if len(password) < 8:
+        reasons.append('shorter than 8 characters')
+
+    bits = max(bits, 0.0)
+    score = sum(1 for threshold in (28, 36, 60, 80) if bits >= threshold)
+    if len(password) < 8:
+        score = min(score, 1)
+    return {'score': score, 'bits': round(bits, 1), 'warnings': reasons}
+
+
+def hash_users_list(path):
+    """
+    Replace plaintext passwords in a users.list with hashes, in place.
+    Returns the number of passwords that were hashed.
+    """
+    with locked(path):
+        lines = read_lines(path)
+        count = 0
+        for i, line in enumerate(lines):
+            fields = line.split('|')
+            if len(fields) < 2 or not fields[0] or not fields[1] or is_hashed(fields[1]):
+                continue
+            fields[1] = hash_password(fields[1])
+            lines[i] = '|'.join(fields)
+            count += 1
+
+        if count:
+            write_lines(path, lines)
+    return count
+
+
+##### /etc/passwd, /etc/shadow and /etc/group
+
+def read_table(path):
+    """Read a colon separated file like /etc/passwd into a list of fields."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return [line.rstrip('\n').split(':') for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def write_atomic(path, data, mode=0o644, fsync=True):
+    """
+    Replace path with data in a single rename, keeping the permissions and
+    ownership of the existing file.
+    """
+    try:
+        st = os.stat(path)
+        mode, uid, gid = st.st_mode & 0o7777, st.st_uid, st.st_gid
+    except FileNotFoundError:
+        uid = gid = None
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        if uid is not None and os.geteuid() == 0:
+            os.chown(tmp, uid, gid)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def format_table(rows):
+    return ''.join(':'.join(row) + '\n' for row in rows)
+
+
+def is_managed(passwd_row):
+    """True for accounts created for FTP sub-users."""
+    gecos, uid, home = passwd_row[4], passwd_row[2], passwd_row[5]
+    if gecos == GECOS:
+        return True
+    # accounts from before the marker, only an FTP uid with a folder under
+    # /ftp/ or an ftp folder in /home/<user>/, never a system account
+    if not uid.isdigit() or not FIRST_UID <= int(uid) <= LAST_UID:
+        return False
+    return home.startswith('/ftp/') or (home.startswith('/home/') and '/ftp/' in home[len('/home/'):])
+
+
+def days_since_epoch():
+    return str(int(time.time() // 86400))
@@ -0,0 +1,374 @@
+"""
+ftp_xferlog.py
+
+Parser for the vsftpd log (vsftpd_log_file in vsftpd.conf), lines look like:
+
+    Sat Oct 17 10:00:01 2026 [pid 122] CONNECT: Client "1.2.3.4"
+    Sat Oct 17 10:00:01 2026 [pid 123] [alice] OK LOGIN: Client "1.2.3.4"
+    Sat Oct 17 10:00:05 2026 [pid 124] [alice] OK DOWNLOAD: Client "1.2.3.4", "/home/x/f", 1048576 bytes, 5120.00Kbyte/sec
+
+Everything is a generator, so a log of any size is read in constant memory.
+
+Inside the docker image this runs next to vsftpd, follows the log file,
+copies every line to the container output (docker logs) and keeps byte and
+file counters per FTP user and per OpenPanel user. The counters are written
+to /etc/openpanel/ftp/users/<owner>/usage.json, where module/ftp.py reads
+them without touching the log:
+
+    python3 ftp_xferlog.py [--log FILE] [--users-dir DIR] [--metrics-port PORT]
+
+Logins and transfers are also published on a unix socket for the live
+view of the OpenPanel module (see ftp_events.py).
+"""
+import argparse
+import calendar
+import json
+import os
+import re
+import signal
+import sys
+import time
+from collections import namedtuple
+
+try:
+    from . import ftp_index, ftp_users
+except ImportError:
+    import ftp_index
+    import ftp_users
+
+
+LOG_FILE = '/var/log/vsftpd.log'
+USAGE_FILE = 'usage.json'
+# seconds between writes of usage.json
+FLUSH_INTERVAL = 10
+# the log is truncated once it is read and larger than this
+MAX_LOG_SIZE = 16 * 1024 * 1024
+# seconds between reloads of the users.list files for unknown users
+OWNERS_RELOAD = 30
+
+
+LINE_RE = re.compile(
+    r'(?P<date>\w{3} \w{3} [ \d]\d \d\d:\d\d:\d\d \d{4}) '
+    r'\[pid (?P<pid>\d+)\] '
+    r'(?:\[(?P<user>[^\]]*)\] )?'
+    r'(?:(?P<result>OK|FAIL) )?(?P<action>[A-Z]+): '
+    r'Client "(?P<client>[^"]*)"'
+    r'(?:, "(?P<path>[^"]*)")?'
+    r'(?:, (?P<bytes>\d+) bytes)?'
+    r'(?:, (?P<rate>[\d.]+)Kbyte/sec)?'
+)
+
+TRANSFERS = ('DOWNLOAD', 'UPLOAD')
+
+_LogEvent = namedtuple('LogEvent', 'time pid user result action client path bytes rate')
+
+
+class LogEvent(_LogEvent):
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.result != 'FAIL'
+
+    @property
+    def duration(self):
+        """Seconds the transfer took, from the size and the logged rate."""
+        if not self.rate:
+            return 0.0
+        return self.bytes / (self.rate * 1024)
+
+
+def parse_time(value):
+    # vsftpd logs in UTC unless use_localtime=YES
+    return calendar.timegm(time.strptime(' '.join(value.split()), '%a %b %d %H:%M:%S %Y'))
+
+
+def parse_line(line):
+    """Return a LogEvent, or None for lines that are not vsftpd log lines."""
+    match = LINE_RE.search(line)
+    if not match:
+        return None
+    try:
+        timestamp = parse_time(match.group('date'))
+    except ValueError:
+        return None
+    return LogEvent(
+        timestamp,
+        int(match.group('pid')),
+        match.group('user') or '',
+        match.group('result') or 'OK',
+        match.group('action'),
+        match.group('client'),
+        match.group('path') or '',
+        int(match.group('bytes') or 0),
+        float(match.group('rate') or 0),
+    )
+
+
+def parse(lines):
+    """Yield a LogEvent for every vsftpd line, anything else is skipped."""
+    for line in lines:
+        event = parse_line(line)
+        if event is not None:
+            yield event
+
+
+def transfers(events):
+    """Only successful uploads and downloads."""
+    for event in events:
+        if event.action in TRANSFERS and event.ok:
+            yield event
+
+
+def follow(path, interval=0.5, max_size=MAX_LOG_SIZE):
+    """
+    Yield new lines appended to path, like tail -F. An empty string is
+    yielded every interval seconds when nothing happened, so callers can do
+    periodic work. A truncated or replaced file is read from the start.
+    """
+    f = None
+    partial = ''
+    while True:
+        if f is None:
+            try:
+                f = open(path, encoding='utf-8', errors='replace')
+            except FileNotFoundError:
+                yield ''
+                time.sleep(interval)
+                continue
+            f.seek(0, os.SEEK_END)
+            inode = os.fstat(f.fileno()).st_ino
+
+        line = f.readline()
+        if line:
+            if line.endswith('\n'):
+                yield partial + line
+                partial = ''
+            else:
+                partial += line
+            continue
+
+        # at the end of the file
+        if max_size and f.tell() > max_size:
+            # vsftpd opens the log with O_APPEND, so it keeps writing at the
+            # new end of the file
+            os.truncate(path, 0)
+            f.seek(0)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_ino != inode:
+            f.close()
+            f = None
+            partial = ''
+            continue
+        if st.st_size < f.tell():
+            f.seek(0)
+        yield ''
+        time.sleep(interval)
+
+
+def usage_path(owner, users_dir=ftp_users.USERS_DIR):
+    return os.path.join(users_dir, owner, USAGE_FILE)
+
+
+def empty_counters():
+    return {'bytes_in': 0, 'bytes_out': 0, 'files_in': 0, 'files_out': 0,
+            'last_login': None, 'last_transfer': None}
+
+
+def read_usage(owner, users_dir=ftp_users.USERS_DIR):
+    """Counters of an OpenPanel user and its FTP users from usage.json."""
+    try:
+        with open(usage_path(owner, users_dir), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'total': empty_counters(), 'users': {}, 'updated': None}
+
+
+class TransferAccounting:
+    """
+    Byte and file counters per FTP user and per owner, fed one LogEvent at
+    a time. Counters continue from the usage.json files that already exist.
+    """
+
+    def __init__(self, users_dir=ftp_users.USERS_DIR, owners=None, index=None):
+        self.users_dir = users_dir
+        self.owners = owners          # ftp user -> owner, loaded lazily
+        self.index = index            # ftp_index.AccountIndex, optional
+        self.owners_loaded = 0
+        self.usage = {}               # owner -> usage dict
+        self.dirty = set()
+        self.last_flush = time.monotonic()
+
+    def owner_of(self, name):
+        if self.index is not None and (self.owners is None or name not in self.owners):
+            # one indexed lookup instead of parsing every users.list
+            try:
+                account = self.index.get(name)
+            except ftp_index.ERRORS:
+                account = None
+            if account is not None:
+                if self.owners is None:
+                    self.owners = {}
+                self.owners[name] = account['owner']
+                return account['owner']
+        if self.owners is None or (name not in self.owners and
+                                   time.monotonic() - self.owners_loaded > OWNERS_RELOAD):
+            users = ftp_users.load_users(self.users_dir)
+            self.owners = dict((user.name, user.owner) for user in users.values())
+            self.owners_loaded = time.monotonic()
+        return self.owners.get(name)
+
+    def seed_index(self):
+        """Copy the counters of every usage.json to the index, on start."""
+        for path in ftp_users.find_users_lists(self.users_dir):
+            owner = ftp_users.owner_for_list(path, self.users_dir)
+            if owner and os.path.exists(usage_path(owner, self.users_dir)):
+                try:
+                    self.index.write_usage(self.usage_for(owner)['users'])
+                except ftp_index.ERRORS as e:
+                    print('Unable to write usage to the account index: %s' % e, file=sys.stderr)
+                    return
+
+    def usage_for(self, owner):
+        if owner not in self.usage:
+            self.usage[owner] = read_usage(owner, self.users_dir)
+        return self.usage[owner]
+
+    def add(self, event):
+        if not event.user or not event.ok or event.action not in TRANSFERS + ('LOGIN',):
+            return
+        owner = self.owner_of(event.user)
+        if owner is None:
+            return
+        usage = self.usage_for(owner)
+        user = usage['users'].setdefault(event.user, empty_counters())
+
+        for counters in (user, usage['total']):
+            if event.action == 'LOGIN':
+                counters['last_login'] = event.time
+            elif event.action == 'UPLOAD':
+                counters['bytes_in'] += event.bytes
+                counters['files_in'] += 1
+                counters['last_transfer'] = event.time
+            else:
+                counters['bytes_out'] += event.bytes
+                counters['files_out'] += 1
+                counters['last_transfer'] = event.time
+        self.dirty.add(owner)
+
+    def flush(self, force=False):
+        """Write usage.json of the owners that changed."""
+        if not self.dirty or (not force and time.monotonic() - self.last_flush < FLUSH_INTERVAL):
+            return
+        for owner in self.dirty:
+            usage = self.usage[owner]
+            usage['updated'] = int(time.time())
+            path = usage_path(owner, self.users_dir)
+            if not os.path.isdir(os.path.dirname(path)):
+                continue
+            ftp_users.write_atomic(path, json.dumps(usage, sort_keys=True), 0o644, fsync=False)
+            if self.index is not None:
+                try:
+                    self.index.write_usage(usage['users'])
+                except ftp_index.ERRORS as e:
+                    print('Unable to write usage to the account index: %s' % e, file=sys.stderr)
+        self.dirty.clear()
+        self.last_flush = time.monotonic()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Follow the vsftpd log and count transfers.')
+    parser.add_argument('--log', default=LOG_FILE, help='vsftpd log file (default: %(default)s)')
+    parser.add_argument('--users-dir', default=ftp_users.USERS_DIR,
+                        help='directory with users.list files (default: %(default)s)')
+    parser.add_argument('--no-index', action='store_true',
+                        help='don\'t write counters to the account index (see ftp_index.py)')
+    parser.add_argument('--no-quota', action='store_true',
+                        help='don\'t measure disk usage and enforce quotas (see ftp_quota.py)')
+    parser.add_argument('--control-socket', default='/run/openpanel/ftp/control.sock',
+                        help='control socket of ftp_sync.py, for quotas (default: %(default)s)')
+    parser.add_argument('--events-socket', default='/run/openpanel/ftp/events.sock',
+                        help='publish transfers on this unix socket, empty to disable '
+                             '(see ftp_events.py, default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve prometheus metrics on this port (see ftp_metrics.py)')
+    parser.add_argument('--metrics-address', default='',
+                        help='address for the metrics port (default: all)')
+    args = parser.parse_args(argv)
+
+    index = None
+    if not args.no_index:
+        try:
+            index = ftp_index.AccountIndex(ftp_index.index_path(args.users_dir))
+        except ftp_index.ERRORS as e:
+            print('Unable to open the account index: %s' % e, file=sys.stderr)
+    accounting = TransferAccounting(args.users_dir, index=index)
+    if index is not None:
+        accounting.seed_index()
+    sinks = [accounting]
+    if index is not None and not args.no_quota:
+        try:
+            from . import ftp_quota
+        except ImportError:
+            import ftp_quota
+
+        def log(msg):
+            print(msg, file=sys.stderr, flush=True)
+
+        # a connection of its own, the scanner writes from another thread
+        try:
+            quota_index = ftp_index.AccountIndex(ftp_index.index_path(args.users_dir))
+        except ftp_index.ERRORS as e:
+            log('Unable to open the account index, quotas are not enforced: %s' % e)
+        else:
+            scanner, _ = ftp_quota.start(args.users_dir, quota_index, args.control_socket, log)
+            sinks.append(scanner)
+    if args.events_socket:
+        try:
+            from . import ftp_events
+        except ImportError:
+            import ftp_events
+        publisher = ftp_events.EventPublisher(args.events_socket, accounting.owner_of)
+        try:
+            publisher.serve()
+            sinks.append(publisher)
+        except OSError as e:
+            print('Unable to publish events on %s: %s' % (args.events_socket, e), file=sys.stderr)
+    if args.metrics_port:
+        try:
+            from . import ftp_metrics
+        except ImportError:
+            import ftp_metrics
+        min_port, max_port = os.environ.get('MIN_PORT'), os.environ.get('MAX_PORT')
+        metrics = ftp_metrics.Metrics(int(min_port) if min_port else None,
+                                      int(max_port) if max_port else None)
+        try:
+            ftp_metrics.serve(metrics, args.metrics_address, args.metrics_port)
+            sinks.append(metrics)
+        except OSError as e:
+            print('Unable to serve metrics on port %d: %s' % (args.metrics_port, e), file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for line in follow(args.log):
+            if line:
+                # keep the log in docker logs
+                sys.stdout.write(line)
+                sys.stdout.flush()
+                event = parse_line(line)
+                if event is not None:
+                    for sink in sinks:
+                        sink.add(event)
+            accounting.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # counters since the last flush would be lost otherwise
+        accounting.flush(force=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,14 @@
 PANEL_CONFIG="/usr/local/panel/conf/panel.config"
 GIT_URL="https://github.com/stefanpejcic/OpenPanel-FTP/archive/refs/heads/master.zip"
 ETC_DIR="/etc/openpanel/ftp/users/"
+FTP_ENV="/etc/openpanel/ftp/ftp.env"
+
+# passive port range, override in $FTP_ENV (see module/ftp_pasv.py)
+MIN_PORT=21000
+MAX_PORT=21010
+if [ -f $FTP_ENV ]; then
+  . $FTP_ENV
+fi
 
 # OpenPanel?
 check_openpanel_installed() {
@@ -18,24 +26,61 @@ check_openpanel_installed() {
 
 # run container
 run_docker_container() {
+  # replace the container if setup is run again, e.g. for a new port range
+  docker rm -f openadmin_ftp > /dev/null 2>&1
+  # other settings of start_vsftpd.sh like MAX_RATE come from $FTP_ENV too
+  if [ -f $FTP_ENV ]; then
+    ENV_FILE_OPT="--env-file $FTP_ENV"
+  fi
+  # prometheus metrics on loopback only, METRICS_PORT= in $FTP_ENV turns them off
+  METRICS_PORT=${METRICS_PORT-9120}
+  if [ -n "$METRICS_PORT" ]; then
+    METRICS_OPT="-p 127.0.0.1:$METRICS_PORT:$METRICS_PORT -e METRICS_PORT=$METRICS_PORT"
+  fi
+  # larger TCP buffers for FTP_PROFILE=throughput, these sysctls are per
+  # network namespace so they only change the container
+  if [ "$FTP_PROFILE" = "throughput" ]; then
+    SYSCTL_OPT=(--sysctl "net.ipv4.tcp_rmem=4096 131072 16777216"
+                --sysctl "net.ipv4.tcp_wmem=4096 131072 16777216"
+                --sysctl net.ipv4.tcp_slow_start_after_idle=0)
+  fi
   docker run -d \
     -p "21:21" \
-    -p 21000-21010:21000-21010 \
+    -p $MIN_PORT-$MAX_PORT:$MIN_PORT-$MAX_PORT \
+    $METRICS_OPT \
+    -e MIN_PORT=$MIN_PORT \
+    -e MAX_PORT=$MAX_PORT \
+    $ENV_FILE_OPT \
+    "${SYSCTL_OPT[@]}" \
     --restart=always \
     --name=openadmin_ftp \
     -v /home:/home \
     -v /etc/openpanel/ftp/users:/etc/openpanel/ftp/users \
+    -v /run/openpanel/ftp:/run/openpanel/ftp \
     --memory="1g" --cpus="1" \
     openpanel/ftp
 }
 
-# open ports
+# open ports, one rule for the whole passive range
 open_ports() {
-  ufw allow 21/tcp
-  for port in $(seq 21000 21010); do
-    ufw allow $port/tcp
+  if ! command -v ufw > /dev/null; then
+    echo "ufw is not installed, open ports 21 and $MIN_PORT-$MAX_PORT/tcp manually."
+    return
+  fi
+
+  UFW_RULES=$(ufw status)
+  CHANGED=0
+  for rule in 21/tcp $MIN_PORT:$MAX_PORT/tcp; do
+    # skip rules that exist from a previous run
+    if ! echo "$UFW_RULES" | grep -q "^$rule "; then
+      ufw allow $rule
+      CHANGED=1
+    fi
   done
-  ufw reload
+
+  if [ $CHANGED -eq 1 ]; then
+    ufw reload
+  fi
 }
 
 #cleanup
@@ -61,7 +106,8 @@ if check_openpanel_installed; then
 
   echo "Building docker image.."
   # build image for now, later download from dockerhub
-  cd OpenPanel-FTP-master && docker build . -t "openpanel/ftp"
+  cd OpenPanel-FTP-master && docker build . -t "openpanel/ftp" \
+    --build-arg PASV_MIN_PORT=$MIN_PORT --build-arg PASV_MAX_PORT=$MAX_PORT
   cd ..
   
   # chech if image exists
@@ -85,10 +131,14 @@ if check_openpanel_installed; then
     echo "Copying OpenPanel module and OpenAdmin extension files.."
     # OpenPanel module
     cp module/ftp.py /usr/local/panel/modules/ftp.py
+    cp module/ftp_users.py module/ftp_xferlog.py module/ftp_cache.py module/ftp_control.py module/ftp_index.py \
+      module/ftp_sessions.py module/ftp_quota.py module/ftp_events.py /usr/local/panel/modules/
     cp module/ftp.html /usr/local/panel/templates/ftp.html
   
     # OpenAdmin extension
     cp module/admin/ftp.py /usr/local/admin/modules/ftp.py
+    cp module/ftp_users.py module/ftp_control.py module/ftp_index.py module/ftp_sessions.py \
+      /usr/local/admin/modules/
     cp module/admin/ftp.html /usr/local/admin/templates/ftp.html
   
   # Check if 'ftp' is in the enabled_modules line
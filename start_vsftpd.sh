@@ -1,21 +1,5 @@
 #!/bin/sh
 
-#Remove all ftp users
-grep '/ftp/' /etc/passwd | cut -d':' -f1 | xargs -r -n1 deluser
-
-#Create users
-#USERS='name1|password1|[folder1][|uid1][|gid1] name2|password2|[folder2][|uid2][|gid2]'
-#may be:
-# user|password foo|bar|/home/foo
-#OR
-# user|password|/home/user/dir|10000
-#OR
-# user|password|/home/user/dir|10000|10000
-#OR
-# user|password||10000|82
-
-#no default user
-
 # Function to determine if a hostname is a FQDN
 is_fqdn() {
   if [[ $1 =~ ^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$ ]]; then
@@ -30,51 +14,44 @@ get_ip_address() {
   hostname -I | awk '{print $1}'
 }
 
-# Function to read users from users.list files and create them
-create_users() {
-  USER_LIST_FILES=$(find /etc/openpanel/ftp/users/ -name 'users.list')
-
-  for USER_LIST_FILE in $USER_LIST_FILES; do
-    BASE_DIR=$(dirname "$USER_LIST_FILE")
-    while IFS='|' read -r NAME PASS FOLDER UID GID; do
-      [ -z "$NAME" ] && continue  # Skip empty lines
-
-      GROUP=$NAME
-
-      if [ -z "$FOLDER" ]; then
-        FOLDER="/ftp/$NAME"
-      fi
-
-      # Ensure the folder starts with /home and matches the base directory where users.list is found
-      if [[ $FOLDER != /home/* ]] || [[ ! $FOLDER == "$BASE_DIR"* ]]; then
-        echo "Skipping user $NAME: folder $FOLDER does not match base directory $BASE_DIR or does not start with /home"
-        continue
-      fi
-
-      if [ ! -z "$UID" ]; then
-        UID_OPT="-u $UID"
-        if [ -z "$GID" ]; then
-          GID=$UID
-        fi
-        GROUP=$(getent group $GID | cut -d: -f1)
-        if [ ! -z "$GROUP" ]; then
-          GROUP_OPT="-G $GROUP"
-        elif [ ! -z "$GID" ]; then
-          addgroup -g $GID $NAME
-          GROUP_OPT="-G $NAME"
-        fi
-      fi
-
-      echo -e "$PASS\n$PASS" | adduser -h $FOLDER -s /sbin/nologin $UID_OPT $GROUP_OPT $NAME
-      mkdir -p $FOLDER
-      chown $NAME:$GROUP $FOLDER
-      unset NAME PASS FOLDER UID GID GROUP UID_OPT GROUP_OPT
-    done < "$USER_LIST_FILE"
-  done
-}
+#Create users from all /etc/openpanel/ftp/users/**/users.list files
+#each line is: name|password[|folder][|uid][|gid][|options]
+#may be:
+# user|password
+#OR
+# foo|bar|/home/foo
+#OR
+# user|password|/home/user/dir|10000
+#OR
+# user|password|/home/user/dir|10000|10000
+#OR
+# user|password||10000|82
+#
+#accounts from a previous run are replaced, all files are written at once.
+#ftp_sync.py then stays in background and applies changes to users.list
+#files while the server is running
+#
+#FTP_USER_MODE=local creates system accounts, FTP_USER_MODE=virtual keeps
+#users in a pam_userdb database for vsftpd guest logins
+if [ -z "$FTP_USER_MODE" ]; then
+  FTP_USER_MODE=local
+fi
 
-# Call the function to create users
-create_users
+#the panel changes accounts through $CONTROL_SOCKET, mount its directory
+#from the host
+if [ -z "$CONTROL_SOCKET" ]; then
+  CONTROL_SOCKET=/run/openpanel/ftp/control.sock
+fi
+
+python3 /usr/local/lib/openpanel-ftp/ftp_sync.py --daemon --mode $FTP_USER_MODE --control-socket $CONTROL_SOCKET
+
+#ftp_admit.py limits the sessions from PAM, which passes it no environment,
+#so the socket is set in the pam_exec line. Logins are not limited while it
+#can't reach the socket
+sed -i "s|\(ftp_admit\.py\) .*|\1 $CONTROL_SOCKET|" /etc/pam.d/vsftpd_local /etc/pam.d/vsftpd_virtual
+if ! python3 -S /usr/local/lib/openpanel-ftp/ftp_admit.py --check $CONTROL_SOCKET; then
+  echo "WARNING: max_sessions limits are not enforced"
+fi
 
 # Set default passive mode port range if not specified
 if [ -z "$MIN_PORT" ]; then
@@ -104,11 +81,81 @@ if [ ! -z "$TLS_CERT" ] || [ ! -z "$TLS_KEY" ]; then
   TLS_OPT="-orsa_cert_file=$TLS_CERT -orsa_private_key_file=$TLS_KEY -ossl_enable=YES -oallow_anon_ssl=NO -oforce_local_data_ssl=YES -oforce_local_logins_ssl=YES -ossl_tlsv1=NO -ossl_sslv2=NO -ossl_sslv3=NO -ossl_ciphers=HIGH"
 fi
 
+# Default bytes per second for every session, users.list options and
+# owner.conf set lower or higher limits per account
+if [ ! -z "$MAX_RATE" ]; then
+  RATE_OPT="-olocal_max_rate=$MAX_RATE"
+fi
+
+# Connection limits for the server and per address, see vsftpd.conf
+if [ ! -z "$MAX_CLIENTS" ]; then
+  LIMIT_OPT="-omax_clients=$MAX_CLIENTS"
+fi
+
+if [ ! -z "$MAX_PER_IP" ]; then
+  LIMIT_OPT="$LIMIT_OPT -omax_per_ip=$MAX_PER_IP"
+fi
+
+# Performance profile, FTP_PROFILE=default|throughput|compat
+# default:    vsftpd.conf as shipped, downloads use sendfile (zero-copy)
+# throughput: sendfile, no reverse DNS on login, passive ports and idle data
+#             connections are released sooner. Start the container with the
+#             --sysctl options from setup.sh for larger TCP buffers
+# compat:     no sendfile, for filesystems that don't support it (some FUSE
+#             and network mounts) or to compare with benchmarks/bench_throughput.py
+# Downloads over TLS are always copied through OpenSSL, without sendfile
+case "$FTP_PROFILE" in
+  ""|default)
+    ;;
+  throughput)
+    PROFILE_OPT="-ouse_sendfile=YES -oreverse_lookup_enable=NO -oaccept_timeout=20 -odata_connection_timeout=120"
+    ;;
+  compat)
+    PROFILE_OPT="-ouse_sendfile=NO"
+    ;;
+  *)
+    echo "Unknown FTP_PROFILE $FTP_PROFILE, using default"
+    ;;
+esac
+
+if [ "$FTP_USER_MODE" = "virtual" ]; then
+  VIRTUAL_OPT="-oguest_enable=YES -ovirtual_use_local_privs=YES -opam_service_name=vsftpd_virtual"
+fi
+
+# Logins need vsftpd built with PAM and the modules of the pam.d service,
+# without them every login fails with no hint why
+check_pam() {
+  if ! grep -q libpam.so "$(command -v vsftpd)"; then
+    echo "ERROR: vsftpd is not linked against libpam, logins are impossible"
+    exit 1
+  fi
+  for module in $(awk '!/^#/ && $3 ~ /\.so$/ {print $3}' /etc/pam.d/$1 | sort -u); do
+    if [ ! -f /lib/security/$module ] && [ ! -f /usr/lib/security/$module ]; then
+      echo "ERROR: $module for /etc/pam.d/$1 is missing, install the package that has it"
+      exit 1
+    fi
+  done
+}
+
 # Used to run custom commands inside container
 if [ ! -z "$1" ]; then
   exec "$@"
 else
-  vsftpd -opasv_min_port=$MIN_PORT -opasv_max_port=$MAX_PORT $ADDR_OPT $TLS_OPT /etc/vsftpd/vsftpd.conf
+  # copy the log to docker logs, count transfers and disk usage per user
+  # and enforce quotas, metrics are served on $METRICS_PORT (set it empty
+  # to disable)
+  if [ ! -z "$METRICS_PORT" ]; then
+    METRICS_OPT="--metrics-port $METRICS_PORT"
+  fi
+  if [ "$FTP_USER_MODE" = "virtual" ]; then
+    check_pam vsftpd_virtual
+  else
+    check_pam vsftpd_local
+  fi
+  touch /var/log/vsftpd.log
+  python3 /usr/local/lib/openpanel-ftp/ftp_xferlog.py --control-socket $CONTROL_SOCKET $METRICS_OPT &
+
+  vsftpd -opasv_min_port=$MIN_PORT -opasv_max_port=$MAX_PORT $ADDR_OPT $TLS_OPT $RATE_OPT $LIMIT_OPT $PROFILE_OPT $VIRTUAL_OPT /etc/vsftpd/vsftpd.conf
   [ -d /var/run/vsftpd ] || mkdir /var/run/vsftpd
   pgrep vsftpd | tail -n 1 > /var/run/vsftpd/vsftpd.pid
   exec pidproxy /var/run/vsftpd/vsftpd.pid true